@@ -1,26 +1,35 @@
 """ Frontend functions for analysis and generation. """
 import os
+import json
+import hashlib
 from pathlib import Path
 from itertools import product
+from functools import lru_cache
 from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 
 import numpy as np
 from numpy.random import default_rng
 import scipy
+from scipy.signal import resample
 import pandas as pd
 import torch
 import torch.nn as nn
 import matplotlib.pyplot as plt
 
-from srcsep.utils import to_numpy, df_product, df_product_channel_single, df_product_channel_double
+from srcsep.utils import to_numpy, hash_data, df_product, df_product_channel_single, df_product_channel_double
+from srcsep.utils import windows, window_starts, window_tapers
 from srcsep.data_source import ProcessDataLoader, FBmLoader, PoissonLoader, MRWLoader, SMRWLoader
 from srcsep.layers.scale_indexer import ScaleIndexer
 from srcsep.layers.described_tensor import Description, DescribedTensor
 from srcsep.layers.layers_basics import ChunkedModule, ChunkedModuleDeglitching, NormalizationLayer
-from srcsep.layers.layers_time import Wavelet
+from srcsep.layers.layers_time import Wavelet, FourierPreconditioner
 from srcsep.layers.moment_layers import Order1Moments, ScatCoefficients, Cov, CovScaleInvariant
 from srcsep.layers.loss import MSELossScat, DeglitchingLoss
-from srcsep.layers.solver import Solver, CheckConvCriterion, SmallEnoughException
+from srcsep.layers.solver import Solver, CheckConvCriterion, EarlyStoppingException
+from srcsep.layers.lbfgs import LBFGS, shift_state
+from srcsep.layers.stochastic import StochasticAdam
 """ Notations
 
 Dimension sizes:
@@ -156,6 +165,9 @@ class Model(nn.Module):
         ).tolist()
         self.c_types_used = c_types_used or c_types
 
+        # compiled versions of compute_moments_real and compute_moments_real_scattering, see compile_moments
+        self.compiled_moments = self.compiled_moments_scattering = None
+
         if dtype == torch.float64:
             self.double()
 
@@ -328,11 +340,15 @@ class Model(nn.Module):
 
         return Description(df)
 
-    def compute_scattering(self, x):
-        """ Compute the Wx, W|Wx|, ..., W|...|Wx||. """
+    def compute_scattering(self, x=None, Wx=None):
+        """ Compute the Wx, W|Wx|, ..., W|...|Wx||.
+
+        :param x: B x N x 1 x 1 x T tensor
+        :param Wx: instead of x, its first wavelet layer before normalization, which is linear in x
+        """
         Sx_l = []
         for order, W in enumerate(self.Ws):
-            x = W(x)
+            x = Wx if order == 0 and Wx is not None else W(x)
             if order == 0:
                 x = self.norm_layer_scale(x)
             Sx_l.append(x)
@@ -342,6 +358,68 @@ class Model(nn.Module):
 
         return Sx_l
 
+    def compute_path_energies(self, x):
+        """ Compute the energy E{|S_p x|^2} of each scattering path p, relative to the energy of the signal the last
+        wavelet of p is applied to, i.e. the fraction of the energy of its parent path captured by p. """
+        energies = []
+        with torch.no_grad():
+            for order, W in enumerate(self.Ws):
+                energy_in = torch.abs(x).pow(2.0).mean((0, 1, 3, 4))
+                x = W(x)
+                if order == 0:
+                    x = self.norm_layer_scale(x)
+                energy_out = torch.abs(x).pow(2.0).mean((0, 1, 3, 4))
+                energies.append(energy_out / energy_in[W.pairing[:, 0]])
+                x = torch.abs(x)
+                if self.no_mean:
+                    x = x - x.mean(-1, keepdim=True)
+
+        return energies
+
+    def prune_paths(self, x, threshold):
+        """ Discard the scattering paths of order >= 2 whose relative energy on the calibration batch x is below
+        threshold, along with the moments built on them.
+
+        :param x: a calibration tensor of shape (B, N, 1, 1, T)
+        :param threshold: relative energy below which a path is discarded
+        :return: the number of paths discarded at each order
+        """
+        if self.model_type == 'covreduced':
+            raise ValueError("Path pruning is not compatible with covreduced model.")
+
+        energies = self.compute_path_energies(x)
+        keep = [np.ones(energies[0].shape[0], dtype=bool)] + \
+               [(energy >= threshold).cpu().numpy() for energy in energies[1:]]
+        self.sc_idxer = ScaleIndexer(r=self.r,
+                                     J=self.sc_idxer.J,
+                                     Q=self.sc_idxer.Q,
+                                     keep=keep)
+        for W in self.Ws:
+            W.sc_idxer = self.sc_idxer
+            W.pairing = W.get_pairing()
+
+        if self.r == 2:
+            self.module_cov_w = Cov(1, 1, self.sc_idxer, 1,
+                                    self.module_cov_w.ave)
+            self.module_cov_wmw = Cov(1, 2, self.sc_idxer, 1,
+                                      self.module_cov_wmw.ave)
+            self.module_cov_mw = Cov(2, 2, self.sc_idxer,
+                                     self.module_cov_mw.nchunks,
+                                     self.module_cov_mw.ave)
+            self.df_cov = Description(
+                self.build_description_correlation([1, 1],
+                                                   self.sc_idxer,
+                                                   channel_mode='full'))
+
+        self.description = self.build_description()
+        self.c_types = None if "c_type" not in self.description.columns else self.description.c_type.unique(
+        ).tolist()
+
+        return [
+            energy.shape[0] - paths.shape[0]
+            for energy, paths in zip(energies, self.sc_idxer.sc_paths)
+        ]
+
     def compute_spars(self, Wx, reshape=True):
         """ Compute E{Wx} and E{|Wx|}. """
         exp = self.module_q1(Wx)
@@ -366,6 +444,46 @@ class Model(nn.Module):
 
         return torch.cat([reshaper(cov) for cov in [cov1, cov2, cov3]], dim=-2)
 
+    @staticmethod
+    def modulus_real(z_re, z_im):
+        """ Modulus with a zero gradient at zero, as torch.abs. """
+        z_mod2 = z_re.pow(2.0) + z_im.pow(2.0)
+        nonzero = z_mod2 > 0
+        return torch.where(nonzero, torch.where(nonzero, z_mod2, torch.ones_like(z_mod2)).sqrt(), 0.0)
+
+    def compute_moments_real(self, x):
+        """ The moments of model_type 'cov' as a plain tensor. Moduli and complex products are computed on real and
+        imaginary parts so that a compiler can fuse the elementwise chains. """
+        W1, W2 = self.Ws
+        Wx = self.norm_layer_scale(W1(x))
+        Wx_mod = self.modulus_real(Wx.real, Wx.imag)
+        WmWx = W2(Wx_mod - Wx_mod.mean(-1, keepdim=True) if self.no_mean else Wx_mod)
+
+        return self.compute_moments_real_scattering(Wx.real, Wx.imag, WmWx.real, WmWx.imag)
+
+    def compute_moments_real_scattering(self, Wx_re, Wx_im, WmWx_re, WmWx_im):
+        """ Same as compute_moments_real, from the real and imaginary parts of the scattering layers Wx, W|Wx|. """
+        Wx_mod = self.modulus_real(Wx_re, Wx_im)
+
+        exp = self.module_q1.forward_real(Wx_re, Wx_im, Wx_mod)
+        covs = [
+            self.module_cov_w.forward_real(Wx_re, Wx_im, Wx_re, Wx_im, channel_mode=self.channel_mode),
+            self.module_cov_wmw.forward_real(Wx_re, Wx_im, WmWx_re, WmWx_im, channel_mode=self.channel_mode),
+            self.module_cov_mw.forward_real(WmWx_re, WmWx_im, WmWx_re, WmWx_im, channel_mode=self.channel_mode)
+        ]
+        y_re, y_im = (torch.cat([y[i].view(y[i].shape[0], -1, y[i].shape[-1]) for y in [exp, *covs]], dim=1)
+                      for i in range(2))
+
+        return torch.complex(y_re, y_im)
+
+    def compile_moments(self):
+        """ Compute the moments in forward and forward_scattering with compiled versions of compute_moments_real and
+        compute_moments_real_scattering, each compiled on its first call. """
+        if self.model_type != 'cov':
+            raise ValueError("Compiled moments are only available for model_type 'cov'.")
+        self.compiled_moments = torch.compile(self.compute_moments_real, dynamic=False)
+        self.compiled_moments_scattering = torch.compile(self.compute_moments_real_scattering, dynamic=False)
+
     def count_coefficients(self, **kwargs) -> int:
         """ Returns the number of moments satisfying kwargs. """
         descri = self.description
@@ -373,20 +491,37 @@ class Model(nn.Module):
             descri = descri.reduce(c_type=self.c_types_used)
         return descri.where(**kwargs).sum()
 
+    def describe(self, y):
+        """ The described tensor of the moments y, reduced to the coefficient types used. """
+        Rx = DescribedTensor(x=None, y=y, descri=self.description)
+
+        if self.c_types_used is not None:
+            return Rx.reduce(c_type=self.c_types_used)
+
+        return Rx
+
     def forward(self, x):
+        if self.compiled_moments is not None:
+            return self.describe(self.compiled_moments(x))
+        return self.forward_scattering(self.compute_scattering(x))
 
-        # scattering layer
-        Sx = self.compute_scattering(x)
+    def forward_scattering(self, Sx):
+        """ Compute the moments from the scattering layers Sx = [Wx, W|Wx|, ...]. Since each channel is transformed
+        independently, Sx can be assembled from the scattering of different signals. """
+        B, T = Sx[0].shape[0], Sx[0].shape[-1]
+
+        if self.compiled_moments_scattering is not None:
+            return self.describe(self.compiled_moments_scattering(Sx[0].real, Sx[0].imag, Sx[1].real, Sx[1].imag))
 
         if self.model_type is None:
 
             y = torch.cat(
-                [out.view(x.shape[0], -1, x.shape[-1]) for out in Sx], dim=1)
+                [out.view(B, -1, T) for out in Sx], dim=1)
 
         elif self.model_type == 'scat':
 
             Sx = torch.cat(
-                [out.view(x.shape[0], -1, x.shape[-1]) for out in Sx], dim=1)
+                [out.view(B, -1, T) for out in Sx], dim=1)
             y = self.module_scat(Sx)
             y = y.view(y.shape[0], -1, y.shape[-1])
 
@@ -436,21 +571,33 @@ class Model(nn.Module):
         if not y.is_complex():
             y = torch.complex(y, torch.zeros_like(y))
 
-        Rx = DescribedTensor(x=None, y=y, descri=self.description)
-
-        if self.c_types_used is not None:
-            return Rx.reduce(c_type=self.c_types_used)
-
-        return Rx
+        return self.describe(y)
 
 
 class ModelDeglitching(nn.Module):
-    """ Should inherit from a cross-scatcov model. That computes interactions between scales of 2 signals. """
-
-    def __init__(self, x_init, nks, cuda, **kwargs):
+    """ Should inherit from a cross-scatcov model. That computes interactions between scales of 2 signals.
+
+    Several windows can be deglitched at once, as independent problems sharing the noise realizations, the filters and
+    the statistics of the noise. Outputs are ordered by realization then window. """
+
+    def __init__(self, x_init, nks, cuda, cache_dir=None, **kwargs):
+        """
+        :param x_init: W x 1 x 1 x 1 x T tensor, the W windows to deglitch
+        :param nks: R x 1 x 1 x 1 x T tensor, the noise realizations
+        :param cache_dir: if not None, the quantities that only depend on the noise realizations and the model are
+            stored in this directory and reused by any model built on the same realizations
+        """
         super(ModelDeglitching, self).__init__()
         self.x_init = x_init  # signal to deglitch
         self.nks = nks  # noises realizations
+        self.n_windows = x_init.shape[0]
+
+        # key of the noise realizations and the model configuration in the cache
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        key = hashlib.sha1(nks.cpu().numpy().tobytes())
+        key.update(repr((nks.dtype, tuple(nks.shape))).encode())
+        key.update(repr(sorted((name, value) for (name, value) in kwargs.items() if name != 'sigma2')).encode())
+        self.cache_key = key.hexdigest()
 
         # init models
         self.phi = Model(**kwargs)
@@ -470,43 +617,94 @@ class ModelDeglitching(nn.Module):
             self.x_init = self.x_init.cuda()
             self.nks = self.nks.cuda()
 
-        # init fixed representations
-        phi_chunked = ChunkedModule(
-            self.phi, nchunks=self.nks.shape[0]
-        )  # chunked version only used for initialization
-        self.phi_x, self.phi_nks = self.phi(self.x_init), phi_chunked(self.nks)
+        # wavelet transforms of the signal and noise realizations, fixed during the optimization
+        self.Wx_init = self.phi.Ws[0](self.x_init).detach()
+        self.Wx_nks, self.Sx_nks = self.cached('wavelet_nks', self.compute_scattering_nks)
+
+        # init fixed representations, phi(nks) and its std only depend on the noise realizations
+        self.phi_x = self.phi(self.x_init)
+        phi_nks_y, self.std_nks = self.cached('phi_nks', self.compute_phi_nks)
+        self.phi_nks = DescribedTensor(x=None, y=phi_nks_y, descri=self.phi_x.descri)
 
         # init weights used in the loss
-        cross_phi_chunked = ChunkedModule(
-            self.cross_phi,
-            nchunks=self.nks.shape[0])  # only used for initialization
-        self.std_nks, self.std_x_nks, self.std_cross = self.init_weight(
-            phi_chunked, cross_phi_chunked)
+        self.std_x_nks, self.std_cross = self.init_weight()
 
         self.description = self.init_description()
         self.c_types = self.phi.c_types
 
-    def init_weight(self, phi_chunked, cross_phi_chunked):
+    def cached(self, name, compute):
+        """ Result of compute, loaded from the cache directory if already computed on the same noise realizations and
+        model. """
+        if self.cache_dir is None:
+            return compute()
+        path = self.cache_dir / f"{name}_{self.cache_key}.pt"
+        if path.is_file():
+            return torch.load(path, map_location=self.nks.device)
+        value = compute()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write then rename so that concurrent deglitchings sharing the cache never load a partial file
+        path_tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        torch.save(value, str(path_tmp))
+        os.replace(str(path_tmp), str(path))
+        return value
+
+    def compute_scattering_nks(self):
+        """ First wavelet layer Wnk of the noise realizations, shared by phi and cross_phi, and the next scattering
+        layers W|Wnk|, ... of cross_phi, one realization at a time. """
+        with torch.no_grad():
+            Wx_l = [self.phi.Ws[0](nk[None, ...]) for nk in self.nks]
+            Sx_l = [self.cross_phi.compute_scattering(Wx=Wx)[1:] for Wx in Wx_l]
+        return torch.cat(Wx_l), [torch.cat(Sx) for Sx in zip(*Sx_l)]
+
+    def compute_phi_nks(self):
+        """ phi(nks) and its std along noise realizations. """
+        phi_nks = self.phi_chunked()
+        return phi_nks.y, phi_nks.y.std(0)[:, 0]
+
+    def phi_chunked(self, Wx=None):
+        """ phi(x+nk) for each noise realization and window of x, one realization at a time, from the first wavelet
+        layer Wx of x, x = 0 if Wx is None. """
+        Rxs = []
+        for Wx_nk in self.Wx_nks.split(1):
+            Rxs.append(self.phi.forward_scattering(self.phi.compute_scattering(Wx=Wx_nk if Wx is None else Wx + Wx_nk)))
+        return DescribedTensor(x=None, y=torch.cat([Rx.y for Rx in Rxs]), descri=Rxs[-1].descri)
+
+    def cross_phi_chunked(self, Wx):
+        """ cross_phi(x, nk) for each noise realization and window of x, one realization at a time, from the first
+        wavelet layer Wx of x. """
+        Sx = self.cross_phi.compute_scattering(Wx=Wx)
+        Rxs = [self.cross_phi.forward_scattering(self.cross_scattering(Sx, np.array([k])))
+               for k in range(self.nks.shape[0])]
+        return DescribedTensor(x=None, y=torch.cat([Rx.y for Rx in Rxs]), descri=Rxs[-1].descri)
+
+    def cross_scattering(self, Sx, bs):
+        """ Scattering layers of (x, nk) in cross_phi for the noise realizations bs and each window of x, from the
+        scattering layers Sx of x. Channels are transformed independently, those of x are shared by all realizations.
+        """
+        Sx_nks = [self.cross_phi.norm_layer_scale(self.Wx_nks[bs, ...])] + [s_nks[bs, ...] for s_nks in self.Sx_nks]
+        return [torch.cat([s.repeat(bs.size, *[1] * (s.ndim - 1)), s_nks.repeat_interleave(s.shape[0], dim=0)], dim=1)
+                for s, s_nks in zip(Sx, Sx_nks)]
+
+    def std_realizations(self, y):
+        """ Std along noise realizations of outputs y ordered by realization then window, of shape W x K. """
+        return y[:, :, 0].reshape(-1, self.n_windows, y.shape[1]).std(0)
+
+    def init_weight(self):
         """ Compute the stds along noise realizations. """
-        # std(phi(nks))
-        std_nks = self.phi_nks.y.std(0)[:, 0]
-
         # std(phi(x-nt+nk)) approximated by std(phi(x+nk))
-        phi_x_nks = phi_chunked(self.x_init + self.nks)
-        std_x_nks = phi_x_nks.y.std(0)[:, 0]
+        phi_x_nks = self.phi_chunked(self.Wx_init)
+        std_x_nks = self.std_realizations(phi_x_nks.y)
 
         # std(phi(x-nt, nk)) approximated by std(phi(x,nk))
-        x_repeat = self.x_init.repeat(self.nks.shape[0], 1, 1, 1, 1)
-        x_nk = torch.cat([x_repeat, self.nks], dim=1)
-        phi_x_nt_nk = cross_phi_chunked(x_nk)
+        phi_x_nt_nk = self.cross_phi_chunked(self.Wx_init)
         c_types = ['spars', 'ps', 'phaseenv', 'envelope'
                    ]  # the coefficient type on which imposing independence
         phi_x_nt_nk_1 = phi_x_nt_nk.reduce(nl=0, nr=1, c_type=c_types)
         phi_x_nt_nk_2 = phi_x_nt_nk.reduce(nl=1, nr=0, c_type=c_types)
-        std_cross1 = phi_x_nt_nk_1.y.std(0)[:, 0]
-        std_cross2 = phi_x_nt_nk_2.y.std(0)[:, 0]
+        std_cross1 = self.std_realizations(phi_x_nt_nk_1.y)
+        std_cross2 = self.std_realizations(phi_x_nt_nk_2.y)
 
-        return std_nks, std_x_nks, [std_cross1, std_cross2]
+        return std_x_nks, [std_cross1, std_cross2]
 
     def init_description(self):
         """ Pandas dataframe used to describe each coefficient. """
@@ -528,26 +726,49 @@ class ModelDeglitching(nn.Module):
         """ Returns the number of moments satisfying kwargs. """
         return -1
 
+    def compile_moments(self):
+        """ Compute the moments of phi and cross_phi with compiled versions. """
+        self.phi.compile_moments()
+        self.cross_phi.compile_moments()
+
     def forward(self, nt, bs):
         """ Compute phi(nt), phi(x-nt+nks), phi(nt,x-nks). """
-        nks_b = self.nks[bs, ...]  # nks for this batch
+        # the first wavelet layer is linear, Wnt is its only transform computed here
+        Wx_nt = self.phi.Ws[0](nt)
+        Wx_x_nt = self.Wx_init - Wx_nt
 
         # statistics phi(nt)
-        y_nt = self.phi(nt).y.repeat(bs.size, 1, 1)
+        y_nt = self.phi.forward_scattering(self.phi.compute_scattering(Wx=Wx_nt)).y.repeat(bs.size, 1, 1)
 
         # statistics phi(x-nt+nk)  # different ks appears as different nl values in self.description
-        y_x_nt_nk = self.phi(self.x_init - nt + nks_b).y
+        Wx_x_nt_nk = Wx_x_nt.repeat(bs.size, *[1] * (Wx_x_nt.ndim - 1)) \
+            + self.Wx_nks[bs, ...].repeat_interleave(self.n_windows, dim=0)
+        y_x_nt_nk = self.phi.forward_scattering(self.phi.compute_scattering(Wx=Wx_x_nt_nk)).y
 
-        # statistics phi(x-nt, nk)
-        x_nt_nk = (self.x_init - nt).repeat(bs.size, 1, 1, 1, 1)
-        x_nt_nk = torch.cat([x_nt_nk, nks_b], dim=1)
-        y_indep = self.cross_phi(x_nt_nk).y
+        # statistics phi(x-nt, nk), the scattering of x-nt is computed once and shared by all realizations
+        Sx_nt = self.cross_phi.compute_scattering(Wx=Wx_x_nt)
+        y_indep = self.cross_phi.forward_scattering(self.cross_scattering(Sx_nt, bs)).y
 
         return DescribedTensor(x=None,
                                y=torch.cat([y_nt, y_x_nt_nk, y_indep], dim=1),
                                descri=self.description)
 
 
+COMPILE_MIN_IT = 1000  # minimum number of iterations for which moments are compiled automatically
+
+
+@lru_cache(maxsize=None)
+def compiler_available():
+    """ Whether torch.compile can generate kernels on this machine, checked once on a small function. """
+    if not hasattr(torch, 'compile'):
+        return False
+    try:
+        torch.compile(lambda t: (t * t).sum())(torch.ones(2))
+    except Exception:
+        return False
+    return True
+
+
 def init_model(model_type, B, N, T, r, J, Q, wav_type, high_freq, wav_norm, qs,
                sigma2, norm_on_the_fly, c_types_used, estim_operator,
                channel_mode, nchunks, dtype, deglitching_params):
@@ -604,6 +825,7 @@ def init_model(model_type, B, N, T, r, J, Q, wav_type, high_freq, wav_norm, qs,
         model = ModelDeglitching(deglitching_params['x_init'],
                                  deglitching_params['nks'],
                                  deglitching_params['cuda'],
+                                 cache_dir=deglitching_params.get('cache_dir'),
                                  model_type=model_type,
                                  qs=qs,
                                  c_types=None,
@@ -782,14 +1004,13 @@ def analyze(x,
     if keep_ps and normalize is not None and model_type in [
             "cov", "covreduced", "scat+cov"
     ] and estim_operator is None:
-        # retrieve the power spectrum that was normalized
+        # retrieve the power spectrum that was normalized, out of place as Rx may be a view on the model output
+        y = Rx.y.clone()
         for n in range(N):
             mask_ps = Rx.descri.where(c_type='ps', nl=n, nr=n)
             if mask_ps.sum() != 0:
-                Rx.y[:,
-                     mask_ps, :] = Rx.y[:,
-                                        mask_ps, :] * sigma2[:, n, :].reshape(
-                                            sigma2.shape[0], -1, 1)
+                y[:, mask_ps, :] = y[:, mask_ps, :] * sigma2[:, n, :].reshape(sigma2.shape[0], -1, 1)
+        Rx = DescribedTensor(x=Rx.x, y=y, descri=Rx.descri, past=Rx.past)
 
     return Rx.cpu()
 
@@ -957,11 +1178,38 @@ class GenDataLoader(ProcessDataLoader):
         path_str = f"{self.model_name}_{wav_type[0]}_B{B_target}_N{N}_T{T}_J{J[0]}_Q1_{Q[0]}_Q2_{Q[1]}_rmax{r}_model_{model_type}" \
                    + f"_tol{kwargs['optim_params']['tol_optim']:.2e}" \
                    + f"_it{kwargs['optim_params']['it']}"
+        if model_params['prune_threshold'] is not None:
+            path_str += f"_prune{model_params['prune_threshold']:.2e}"
+        # solver options changing the trajectories, a generation with the default ones keeps its path
+        optim_params = kwargs['optim_params']
+        if optim_params['method'] != 'L-BFGS-B':
+            path_str += f"_{optim_params['method']}"
+        options = {key: optim_params[key] for key in ['batched', 'multiscale', 'early_stopping', 'precondition']
+                   if optim_params[key] not in [None, False]}
+        if optim_params['method'] == 'adam':
+            options['stochastic_params'] = optim_params['stochastic_params']
+        if optim_params['lbfgs_history'] is not None:
+            options['lbfgs_history'] = True
+        if model_params['deglitching_params'] is not None and model_params['deglitching_params'].get(
+                'support') is not None:
+            options['support'] = model_params['deglitching_params']['support']
+        if options:
+            path_str += f"_opt{hash_data(options)[:10]}"
         return self.dir_name / path_str.replace('.', '_').replace('-', '_')
 
-    def generate_trajectory(self, seed, x, Rx, model_params, optim_params, gpu,
-                            dirpath):
-        """ Performs cached generation. """
+    def generate_trajectory(self,
+                            seed,
+                            x,
+                            Rx,
+                            model_params,
+                            optim_params,
+                            gpu,
+                            dirpath,
+                            n_syntheses=1,
+                            checkpoint_path=None):
+        """ Performs cached generation. If n_syntheses > 1, the syntheses are stacked along the batch dimension and
+        solved jointly, with a target representation and a model built once. If checkpoint_path is an existing
+        checkpoint of the same problem, the optimization resumes from it. """
         if gpu is not None:
             os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu)
         np.random.seed(seed)
@@ -969,6 +1217,13 @@ class GenDataLoader(ProcessDataLoader):
         if filename.is_file():
             raise OSError("File for saving this trajectory already exists.")
 
+        # a checkpoint is only resumed by the problem that saved it, read first as it makes the coarse solves useless
+        checkpoint_key = None if checkpoint_path is None else hash_data(
+            seed, x, None if Rx is None else Rx.y, n_syntheses, model_params,
+            {key: value for (key, value) in optim_params.items()
+             if key not in ['gpus', 'diagnostics', 'checkpoint_every', 'profile']})
+        checkpoint = CheckConvCriterion.read_checkpoint(checkpoint_path, checkpoint_key)
+
         x_torch = torch.from_numpy(x.astype(
             np.float64)).unsqueeze(-2).unsqueeze(-2)
         # sigma = None
@@ -978,25 +1233,56 @@ class GenDataLoader(ProcessDataLoader):
                                 model_params['wav_norm'],
                                 model_params['nchunks'], optim_params['cuda'])
 
-        model_params['sigma2'] = sigma2.mean(
-            0, keepdim=True)  # do a "batch_ps" normalization
+        # do a "batch_ps" normalization, on a copy as model_params is shared by the jobs and keys their checkpoints
+        model_params = {**model_params, 'sigma2': sigma2.mean(0, keepdim=True)}
 
         # initialize model
-        model = init_model(B=x.shape[0], **model_params)
+        model = init_model(B=x.shape[0] * n_syntheses,
+                           **{
+                               key: value
+                               for (key, value) in model_params.items()
+                               if key != 'prune_threshold'
+                           })
         if optim_params['cuda'] and gpu is not None:
             x_torch = x_torch.cuda()
             model = model.cuda()
 
+        # discard scattering paths carrying negligible energy on x
+        if model_params['prune_threshold'] is not None:
+            n_pruned = model.module.prune_paths(
+                x_torch, model_params['prune_threshold'])
+            print(f"Pruned {n_pruned} scattering paths at each order.")
+
+        # compiled moments, automatically on cpu for runs long enough to amortize compilation
+        compiled = optim_params['compiled']
+        if compiled is None:
+            compiled = not optim_params['cuda'] and model_params['model_type'] == 'cov' \
+                and optim_params['it'] >= COMPILE_MIN_IT and compiler_available()
+        if compiled:
+            model.module.compile_moments()
+
+        # optimize on scale-normalized Fourier coefficients of x
+        preconditioner = None
+        if optim_params['precondition']:
+            phi = model.module if model_params['deglitching_params'] is None else model.module.phi
+            preconditioner = FourierPreconditioner.from_power_spectrum(
+                phi.Ws[0], model_params['sigma2'])
+
         # prepare target representation
         if Rx is None:
             if model_params['deglitching_params'] is None:
                 Rx = model(x_torch).cpu()
             else:
                 Rx = None
+        if Rx is not None and n_syntheses > 1:
+            Rx = DescribedTensor.cat_batch(*[Rx] * n_syntheses)
 
         # prepare initial gaussian process
-        if optim_params['x0'] is not None:
-            x0 = optim_params['x0']
+        if optim_params['multiscale'] and checkpoint is None:
+            x0 = self.solve_coarse(seed, x, model_params, optim_params, gpu,
+                                   dirpath, n_syntheses)
+        elif optim_params['x0'] is not None:
+            x0 = np.concatenate([optim_params['x0']] * n_syntheses)
         else:
             x0_mean = x.mean(-1).mean(0)
             x0_var = np.var(x, axis=-1).mean(0)
@@ -1010,19 +1296,29 @@ class GenDataLoader(ProcessDataLoader):
 
                 return wn * var[:, None] + mean[:, None]
 
-            x0 = gen_wn(x.shape, x0_mean, x0_var**0.5)
+            if n_syntheses == 1:
+                x0 = gen_wn(x.shape, x0_mean, x0_var**0.5)
+            else:
+                x0_l = []
+                for seed_s in optim_params['seed'][:n_syntheses]:
+                    np.random.seed(seed_s)
+                    x0_l.append(gen_wn(x.shape, x0_mean, x0_var**0.5))
+                x0 = np.concatenate(x0_l)
 
         # init loss, solver and convergence criterium
         if model_params['deglitching_params'] is None:
-            loss = MSELossScat()
+            # the loss is bound to the target representation, which is fixed during the optimization
+            loss = MSELossScat(target=Rx)
             # This renders `fixed_ts` useless in this case.
             solver_fn = Solver(model=model,
                                loss=loss,
-                               xf=x,
-                               Rxf=Rx,
+                               xf=x0,
+                               Rxf=None,
                                x0=x0,
                                fixed_ts=None,
-                               cuda=optim_params['cuda'])
+                               cuda=optim_params['cuda'],
+                               profile=optim_params['profile'],
+                               preconditioner=preconditioner)
         else:
             loss = DeglitchingLoss(
                 phi_x=model.module.phi_x,
@@ -1030,6 +1326,7 @@ class GenDataLoader(ProcessDataLoader):
                 std_nks=model.module.std_nks,
                 std_x_nks=model.module.std_x_nks,
                 std_cross=model.module.std_cross,
+                descri=model.module.description,
                 x_loss_w=model_params['deglitching_params']['x_loss_w'],
                 indep_loss_w=model_params['deglitching_params']
                 ['indep_loss_w'])
@@ -1040,10 +1337,25 @@ class GenDataLoader(ProcessDataLoader):
                 Rxf=Rx,
                 x0=x0,
                 fixed_ts=model_params['deglitching_params']['fixed_ts'],
-                cuda=optim_params['cuda'])
+                cuda=optim_params['cuda'],
+                profile=optim_params['profile'],
+                preconditioner=preconditioner,
+                support=model_params['deglitching_params'].get('support'))
 
         check_conv_criterion = CheckConvCriterion(
-            solver=solver_fn, tol=optim_params['tol_optim'])
+            solver=solver_fn,
+            tol=optim_params['tol_optim'],
+            diagnostics=optim_params['diagnostics'],
+            checkpoint_path=checkpoint_path,
+            checkpoint_every=optim_params['checkpoint_every'],
+            checkpoint_key=checkpoint_key,
+            early_stopping=optim_params['early_stopping'])
+
+        # resume from the last checkpoint of this job if any, scipy methods restart without curvature information
+        if checkpoint is not None:
+            check_conv_criterion.load_checkpoint(checkpoint)
+            x0 = solver_fn.from_variable(checkpoint['x'].numpy()).reshape(x0.shape)
+            print(f"Resuming from checkpoint at iteration {check_conv_criterion.counter}.")
 
         print('Embedding: uses {} coefficients {}'.format(
             model.module.count_coefficients(), ' '.join([
@@ -1055,39 +1367,101 @@ class GenDataLoader(ProcessDataLoader):
         method, maxfun, jac = optim_params['method'], optim_params[
             'maxfun'], optim_params['jac']
         relative_optim, it = optim_params['relative_optim'], optim_params['it']
+        it = it - check_conv_criterion.counter
 
         tic = time()
         # Decide if the function provides gradient or not
         func = solver_fn.joint if jac else solver_fn.function
+        # the optimization variable, x itself if not preconditioned
+        z0 = solver_fn.to_variable(x0)
         try:
-            res = scipy.optimize.minimize(func,
-                                          x0.reshape(-1),
-                                          method=method,
-                                          jac=jac,
-                                          callback=check_conv_criterion,
-                                          options={
-                                              'ftol': 1e-24,
-                                              'gtol': 1e-24,
-                                              'maxiter': it,
-                                              'maxfun': maxfun
-                                          })
+            if method == 'torch-lbfgs':
+                # L-BFGS on torch tensors, x stays on device until the end
+                x0_flat = solver_fn.format_flat(z0)
+                optimizer = LBFGS(solver_fn.joint_torch, ftol=1e-24, gtol=1e-24)
+                if checkpoint is not None and checkpoint['optimizer'] is not None:
+                    optimizer.load_state_dict(checkpoint['optimizer'],
+                                              device=x0_flat.device)
+                elif optim_params['lbfgs_history'] is not None and Path(optim_params['lbfgs_history']).is_file():
+                    optimizer.load_state_dict(torch.load(optim_params['lbfgs_history']),
+                                              device=x0_flat.device)
+                check_conv_criterion.optimizer = optimizer
+                res = optimizer.minimize(x0_flat,
+                                         maxiter=it,
+                                         maxfun=maxfun,
+                                         callback=check_conv_criterion)
+            elif method == 'adam':
+                # Adam on mini-batches of noise realizations, convergence is checked on the full objective
+                stochastic_params = optim_params['stochastic_params']
+                x0_flat = solver_fn.format_flat(z0)
+                optimizer = StochasticAdam(
+                    solver_fn.joint_torch,
+                    solver_fn.joint_torch,
+                    n_realizations=model_params['deglitching_params']['nks'].shape[0],
+                    batch_size=stochastic_params['batch_size'],
+                    lr=stochastic_params['lr'] * float(x0_flat.std()),
+                    lr_decay=stochastic_params['lr_decay'],
+                    decay_every=stochastic_params['decay_every'],
+                    eval_every=stochastic_params['eval_every'],
+                    seed=seed)
+                # the criterion counts evaluations of the full objective, the budget is in steps
+                if checkpoint is not None and checkpoint['optimizer'] is not None:
+                    optimizer.load_state_dict(checkpoint['optimizer'], device=x0_flat.device)
+                check_conv_criterion.optimizer = optimizer
+                res = optimizer.minimize(x0_flat,
+                                         maxiter=optim_params['it'],
+                                         callback=check_conv_criterion)
+            else:
+                res = scipy.optimize.minimize(func,
+                                              z0,
+                                              method=method,
+                                              jac=jac,
+                                              callback=check_conv_criterion,
+                                              options={
+                                                  'ftol': 1e-24,
+                                                  'gtol': 1e-24,
+                                                  'maxiter': it,
+                                                  'maxfun': maxfun
+                                              })
             loss_tmp, x_opt, it, msg = res['fun'], res['x'], res['nit'], res[
                 'message']
-        except SmallEnoughException:  # raised by check_conv_criterion
-            print('SmallEnoughException')
+        except EarlyStoppingException as e:  # raised by check_conv_criterion
+            print(type(e).__name__)
             x_opt = check_conv_criterion.result
             it = check_conv_criterion.counter
-            msg = "SmallEnoughException"
+            msg = str(e)
+        if torch.is_tensor(x_opt):
+            x_opt = x_opt.cpu().numpy()
+        if method == 'torch-lbfgs' and optim_params['lbfgs_history'] is not None:
+            torch.save(optimizer.state_dict(), optim_params['lbfgs_history'])
 
         toc = time()
+        nfev = solver_fn.nfev
+        self.timings = solver_fn.timings
 
         flo, fgr = solver_fn.joint(x_opt)
         flo, fgr = flo, np.max(np.abs(fgr))
-        x_synt = x_opt.reshape(x0.shape)
+        x_synt = solver_fn.from_variable(x_opt).reshape(x0.shape)
 
         if not isinstance(msg, str):
             msg = msg.decode("ASCII")
 
+        # stored along the trajectories by the worker
+        self.optim_info = {
+            'message': msg,
+            'nit': int(it),
+            'nfev': nfev,
+            'nhits': solver_fn.nhits,
+            'loss': float(flo),
+            'gerr': float(fgr),
+            'time': toc - tic
+        }
+        if model_params['deglitching_params'] is not None:
+            # the windows are independent problems, the loss being their average
+            with torch.no_grad():
+                loss(model(solver_fn.format(x_synt, requires_grad=False)), None, None, None)
+            self.optim_info['window_losses'] = loss.window_losses.cpu().tolist()
+
         print('Optimization Exit Message : ' + msg)
         print(
             f"found parameters in {toc - tic:0.2f}s, {it} iterations -- {it / (toc - tic):0.2f}it/s"
@@ -1101,22 +1475,97 @@ class GenDataLoader(ProcessDataLoader):
 
         return x_synt  # S x N x T
 
-    def worker(self, i, **kwargs):
+    def solve_coarse(self, seed, x, model_params, optim_params, gpu, dirpath,
+                     n_syntheses):
+        """ Generation on x decimated by 2 with one octave less, itself initialized by the coarser levels of the
+        multiscale schedule, upsampled to the resolution of x. """
+        T = x.shape[-1]
+        model_params_coarse = {
+            **model_params, 'T': T // 2,
+            'J': [j - 1 for j in model_params['J']],
+            'sigma2': None
+        }
+        optim_params_coarse = {
+            **optim_params, 'it':
+            optim_params['multiscale'][-1],
+            'multiscale':
+            optim_params['multiscale'][:-1],
+            'x0':
+            None if optim_params['x0'] is None else resample(
+                optim_params['x0'], T // 2, axis=-1),
+            'checkpoint_every':
+            None,
+            'lbfgs_history':
+            None
+        }
+        x_coarse = resample(x, T // 2, axis=-1).astype(x.dtype)
+
+        print(f"Multiscale schedule: solving at resolution T={T // 2}.")
+        x_synt_coarse = self.generate_trajectory(seed, x_coarse, None,
+                                                 model_params_coarse,
+                                                 optim_params_coarse, gpu,
+                                                 dirpath, n_syntheses)
+
+        return resample(x_synt_coarse, T, axis=-1).astype(x.dtype)
+
+    def generate(self, dirpath, n_jobs, **kwargs):
+        """ Performs a cached generation saving into dirpath, as a single batched job if required. """
+        # jobs are numbered after the trajectories already saved, so that a restarted job keeps its seed and checkpoint
+        kwargs['job_offset'] = len(list(dirpath.glob('*')))
+        if not kwargs['optim_params']['batched']:
+            return super(GenDataLoader, self).generate(dirpath, n_jobs,
+                                                       **kwargs)
+        print(f"{self.model_name}: generating data.")
+        kwargs_gen = {
+            key: value
+            for key, value in kwargs.items() if key != 'n_files'
+        }
+        self.worker(0, **{
+            **kwargs_gen,
+            **{
+                'dirpath': dirpath,
+                'n_syntheses': n_jobs
+            }
+        })
+        return kwargs
+
+    def worker(self, i, job_offset=0, **kwargs):
         cuda = kwargs['optim_params']['cuda']
         gpus = kwargs['optim_params']['gpus']
-        seed = kwargs['optim_params']['seed'][i]
-        kwargs['seed'] = seed
+        # seeds of this job and, for a batched job, of the next syntheses
+        job = job_offset + i
+        kwargs['optim_params'] = {**kwargs['optim_params'], 'seed': kwargs['optim_params']['seed'][job:]}
+        kwargs['seed'] = kwargs['optim_params']['seed'][0]
         if cuda and gpus is None:
             kwargs['gpu'] = '0'
         elif cuda and gpus is not None:
             kwargs['gpu'] = str(gpus[i % len(gpus)])
         else:
             kwargs['gpu'] = None
+        if kwargs['optim_params']['checkpoint_every'] is not None:
+            checkpoint_dir = kwargs['dirpath'].parent / f"{kwargs['dirpath'].name}_checkpoints"
+            checkpoint_dir.mkdir(exist_ok=True)
+            kwargs['checkpoint_path'] = checkpoint_dir / f"{job}.pt"
         try:
             x = self.generate_trajectory(**kwargs)
-            fname = f"{np.random.randint(1e7, 1e8)}.npy"
-            np.save(str(kwargs['dirpath'] / fname), x)
-            print(f"Saved: {kwargs['dirpath'].name}/{fname}")
+            # optimization results are stored outside dirpath, every file of which is loaded as a trajectory
+            logs_dir = kwargs['dirpath'].parent / f"{kwargs['dirpath'].name}_logs"
+            logs_dir.mkdir(exist_ok=True)
+            # one file per synthesis
+            for x_s in np.split(x, kwargs.get('n_syntheses', 1)):
+                fname = f"{np.random.randint(1e7, 1e8)}"
+                np.save(str(kwargs['dirpath'] / f"{fname}.npy"), x_s)
+                with open(logs_dir / f"{fname}.json", 'w') as f:
+                    json.dump(self.optim_info, f)
+                if kwargs['optim_params']['profile']:
+                    # the syntheses of a batch share their evaluations, each one is attributed its share of the time
+                    n_syntheses = kwargs.get('n_syntheses', 1)
+                    with open(logs_dir / f"{fname}.jsonl", 'w') as f:
+                        f.writelines(json.dumps({**timing, 'n_syntheses': n_syntheses}) + '\n'
+                                     for timing in self.timings)
+                print(f"Saved: {kwargs['dirpath'].name}/{fname}.npy")
+            if kwargs.get('checkpoint_path') is not None and kwargs['checkpoint_path'].is_file():
+                kwargs['checkpoint_path'].unlink()
         except ValueError as e:
             print(e)
             return
@@ -1145,6 +1594,18 @@ def generate(x,
              cuda=False,
              gpus=None,
              num_workers=1,
+             prune_threshold=None,
+             method='L-BFGS-B',
+             diagnostics='milestone',
+             batched=False,
+             checkpoint_every=None,
+             multiscale=None,
+             stochastic_params=None,
+             early_stopping=None,
+             profile=False,
+             compiled=None,
+             precondition=False,
+             lbfgs_history=None,
              deglitching_params=None):
     """ Generate new realizations of x from a scattering covariance model.
     We first compute the scattering covariance representation of x and then sample it using gradient descent.
@@ -1172,7 +1633,39 @@ def generate(x,
     :param cuda: does calculation on gpu
     :param gpus: a list of gpus to use
     :param num_workers: number of generation workers
-    :param deglitching_params: dict containing signal x = n + g to deglitch and noise realizations \tilde{n}
+    :param prune_threshold: if not None, discard scattering paths whose relative energy on x is below this threshold
+    :param method: optimization method, a scipy.optimize.minimize method, 'torch-lbfgs' to run L-BFGS on device or,
+        for deglitching, 'adam' to run Adam on mini-batches of noise realizations
+    :param diagnostics: when to compute loss gap statistics: 'always', 'milestone' (when printed) or every k iterations
+    :param batched: solve all syntheses jointly, stacked along the batch dimension of a single solver
+    :param checkpoint_every: checkpoint the optimization every k iterations, an interrupted generation called again
+        with the same parameters resumes from its last checkpoint. For method 'adam', an iteration is an evaluation of
+        the full objective, i.e. eval_every steps
+    :param multiscale: coarse-to-fine schedule, list of the numbers of iterations at each coarse level from coarsest to
+        finest, e.g. [500, 500] first solves on x decimated by 4 with J-2 octaves, then by 2 with J-1 octaves,
+        each level being initialized by the upsampled solution of the previous one
+    :param stochastic_params: dict for method 'adam', containing the number of realizations per step batch_size, the
+        learning rate lr relative to the std of the initial signal, its decay factor lr_decay applied every
+        decay_every steps and the number of steps eval_every between two evaluations of the full objective
+    :param early_stopping: dict of stopping policies, each one optional: 'window' and 'rtol' stop when the relative loss
+        improvement over the last window iterations is below rtol (default 1e-3), 'gtol' is a floor on the max
+        absolute gradient, 'max_time' a wall-clock budget in seconds and 'max_fev' a budget of loss evaluations,
+        the stopping reason is stored with each trajectory in the _logs directory next to the generated dir
+    :param profile: record the time spent in each phase of each loss evaluation and iteration, written as JSONL with
+        each trajectory in the _logs directory, see timing_summary
+    :param compiled: compute the moments with torch.compile, only for model_type 'cov', None chooses automatically:
+        compiled on cpu when torch.compile is available and it >= COMPILE_MIN_IT, to amortize compilation time
+    :param precondition: optimize on the Fourier coefficients of x normalized by the wavelet power spectrum of x,
+        which balances the convergence speed across scales
+    :param lbfgs_history: for method 'torch-lbfgs', a file holding the curvature history of L-BFGS, if it exists the
+        optimization starts from this history, the final history is written to it, see deglitch_chain
+    :param deglitching_params: dict containing signal x = n + g to deglitch and noise realizations \tilde{n}, and
+        optionally a cache_dir in which the quantities that only depend on the noise realizations are stored, to be
+        reused by later deglitchings with the same realizations and model. Windows x of shape (W, 1, T) are
+        deglitched jointly as W independent problems sharing the noise realizations, x_init holding the same windows,
+        the loss of each window is stored with the trajectory in the _logs directory. An optional support, boolean
+        mask of size T, restricts the optimization to the time samples it contains, the others keeping their value in
+        x0, which reduces the search space to the samples affected by the glitch
 
     :return: a DescribedTensor result
     """
@@ -1199,10 +1692,47 @@ def generate(x,
         seed = [seed] * S
     if qs is None:
         qs = [1.0, 2.0]
+    if method == 'adam':
+        stochastic_params = {
+            'batch_size': 10,
+            'lr': 1e-2,
+            'lr_decay': 0.5,
+            'decay_every': 500,
+            'eval_every': 50,
+            **(stochastic_params or {})
+        }
     if generated_dir is None:
         generated_dir = Path(__file__).parents[0] / '_cached_dir'
     if x0 is not None and x0.shape != x.shape:
         raise ValueError(f"If specified, x0 should be of shape {x.shape}")
+    if prune_threshold is not None and (Rx is not None
+                                        or deglitching_params is not None):
+        raise ValueError(
+            "Path pruning calibrates the model on x, it cannot be used with a given Rx or for deglitching."
+        )
+    if batched and deglitching_params is not None:
+        raise ValueError("Batched generation is not available for deglitching.")
+    if precondition and deglitching_params is not None and deglitching_params['fixed_ts'] is not None:
+        raise ValueError("Fixed time indices cannot be imposed on a preconditioned variable.")
+    if deglitching_params is not None and deglitching_params.get('support') is not None \
+            and (precondition or deglitching_params['fixed_ts'] is not None):
+        raise ValueError("A support cannot be combined with fixed time indices or a preconditioned variable.")
+    if compiled and model_type != 'cov':
+        raise ValueError("Compiled moments are only available for model_type 'cov'.")
+    if lbfgs_history is not None and (method != 'torch-lbfgs' or precondition or (
+            deglitching_params is not None and deglitching_params.get('support') is not None)):
+        raise ValueError("A L-BFGS history is only carried by method 'torch-lbfgs' on the signal itself.")
+    if method == 'adam' and deglitching_params is None:
+        raise ValueError("Stochastic optimization samples noise realizations, it is only available for deglitching.")
+    if multiscale:
+        if Rx is not None or deglitching_params is not None:
+            raise ValueError(
+                "Multiscale schedule computes coarse targets on x, it cannot be used with a given Rx or for deglitching."
+            )
+        if len(multiscale) >= min(J) or T % 2**len(multiscale) != 0:
+            raise ValueError(
+                "Multiscale schedule has too many levels for the number of octaves or time samples."
+            )
 
     # use a GenDataLoader to cache trajectories
     dtld = GenDataLoader(exp_name or 'gen_scat_cov', generated_dir,
@@ -1227,6 +1757,7 @@ def generate(x,
         'estim_operator': None,
         'channel_mode': channel_mode,
         'dtype': torch.float64 if x.dtype == np.float64 else torch.float32,
+        'prune_threshold': prune_threshold,
         'deglitching_params': deglitching_params
     }
 
@@ -1237,16 +1768,26 @@ def generate(x,
         'gpus': gpus,
         'relative_optim': False,
         'maxfun': 2e6,
-        'method': 'L-BFGS-B',
+        'method': method,
         'jac':
         True,  # origin of gradient, True: provided by solver, else estimated
         'tol_optim': tol_optim,
         'seed': seed,
-        'x0': x0
+        'x0': x0,
+        'diagnostics': diagnostics,
+        'batched': batched,
+        'checkpoint_every': checkpoint_every,
+        'multiscale': multiscale,
+        'stochastic_params': stochastic_params,
+        'early_stopping': early_stopping,
+        'profile': profile,
+        'compiled': compiled,
+        'precondition': precondition,
+        'lbfgs_history': lbfgs_history
     }
 
-    # multi-processed generation
-    x_gen = dtld.load(R=S,
+    # multi-processed generation, deglitching returns every window
+    x_gen = dtld.load(R=S if deglitching_params is None else S * B,
                       n_files=int(np.ceil(S / B)),
                       x=x,
                       Rx=Rx,
@@ -1256,6 +1797,216 @@ def generate(x,
     return x_gen
 
 
+##################
+# DEGLITCHING
+##################
+
+
+def glitch_score(x):
+    """ Largest deviation of x from its median along time, in units of its robust std, cheap to compute.
+
+    :param x: an array of shape (..., T)
+    :return: an array of shape (...)
+    """
+    median = np.median(x, axis=-1, keepdims=True)
+    mad = np.median(np.abs(x - median), axis=-1, keepdims=True)
+    return np.max(np.abs(x - median), axis=-1) / (1.4826 * mad[..., 0] + 1e-30)
+
+
+def deglitch_windows(x, nks, x0=None, x_loss_w=1.0, indep_loss_w=1.0, cache_dir=None, exp_name=None, **kwargs):
+    """ Deglitch windows jointly, as independent problems sharing the noise realizations. The generation is cached
+    under exp_name suffixed by a hash of the windows, the noise realizations and the initial estimates.
+
+    :param x: an array of shape (W, T), the windows to deglitch
+    :param nks: an array of shape (R, T), the noise realizations
+    :param x0: an array of shape (W, T), the initial estimates, x if None
+    :param cache_dir: directory in which the quantities that only depend on the noise realizations are cached
+    :param exp_name: experience name, prefix of the generation name
+    :param kwargs: passed to generate
+    :return: an array of shape (W, T)
+    """
+    # generations are cached by name and parameters only, the name identifies the data
+    key = hash_data(x, nks, x0, x_loss_w, indep_loss_w)
+    exp_name = f"{exp_name or 'deglitch'}_{key[:16]}"
+
+    x = x[:, None, :]
+    deglitching_params = {
+        'nks': format_tensor(nks[:, None, :]),
+        'x_init': format_tensor(x),
+        'indep_loss_w': indep_loss_w,
+        'x_loss_w': x_loss_w,
+        'fixed_ts': None,
+        'cuda': kwargs.get('cuda', False),
+        'cache_dir': cache_dir
+    }
+    x0 = x if x0 is None else x0[:, None, :]
+    return generate(x, x0=x0, deglitching_params=deglitching_params, exp_name=exp_name, **kwargs)[:, 0, :]
+
+
+def deglitch_chain(x, starts, nks, exp_name, lbfgs_history=None, **kwargs):
+    """ Deglitch adjacent overlapping windows one after the other, each one being warm started by the estimate of the
+    previous window on their overlap and, optionally, by its L-BFGS curvature history translated along time.
+
+    Each window is cached under a name identifying its warm start, see deglitch_windows. A window loaded from the cache
+    produces no curvature history, the next window then starts without one.
+
+    :param x: an array of shape (W, T), the windows to deglitch
+    :param starts: the start of each window in the record
+    :param nks: an array of shape (R, T), the noise realizations
+    :param exp_name: experience name, prefix of the window names
+    :param lbfgs_history: if not None, a file in which the curvature history is carried from one window to the next,
+        requires method 'torch-lbfgs'
+    :param kwargs: passed to deglitch_windows
+    :return: an array of shape (W, T)
+    """
+    T = x.shape[-1]
+
+    x_hat = np.zeros_like(x)
+    state = None  # curvature history of the previous window
+    for i in range(x.shape[0]):
+        if lbfgs_history is not None and Path(lbfgs_history).is_file():
+            Path(lbfgs_history).unlink()  # left by the previous window or run
+        x0 = x[i:i + 1].copy()
+        if i > 0:
+            shift = starts[i] - starts[i - 1]
+            x0[:, :T - shift] = x_hat[i - 1, shift:]
+            if state is not None:
+                torch.save(shift_state(state, shift, T), lbfgs_history)
+        x_hat[i] = deglitch_windows(x[i:i + 1], nks, x0=x0, exp_name=f"{exp_name}_{starts[i]}",
+                                    lbfgs_history=lbfgs_history, **kwargs)[0]
+        state = None
+        if lbfgs_history is not None and Path(lbfgs_history).is_file():
+            state = torch.load(lbfgs_history)
+            # shift_state resets the counters, a window loaded from the cache did not iterate from its history
+            state = state if state['nit'] > 0 else None
+
+    if lbfgs_history is not None and Path(lbfgs_history).is_file():
+        Path(lbfgs_history).unlink()
+
+    return x_hat
+
+
+def deglitch(x,
+             nks,
+             window_size,
+             hop,
+             windows_per_job=1,
+             n_jobs=1,
+             detection_quantile=0.99,
+             taper_alpha=0.5,
+             output_path=None,
+             warm_start=False,
+             lbfgs_history=False,
+             generated_dir=None,
+             exp_name=None,
+             **kwargs):
+    """ Deglitch a long record by overlapping windows, stitched back by a taper-weighted overlap-add.
+
+    Windows whose glitch_score does not exceed the detection_quantile of the scores of the noise realizations are
+    considered glitch-free and kept as they are. The others are deglitched by jobs of windows_per_job windows,
+    scheduled over a pool of n_jobs processes. Each job is cached as a generation, a pipeline called again with the
+    same record and parameters only runs the jobs that did not complete. The output is written as jobs complete.
+
+    With warm_start, each run of adjacent glitched windows is a job deglitching its windows one after the other, see
+    deglitch_chain, the runs being scheduled over the pool.
+
+    :param x: an array of shape (T, ), the record
+    :param nks: an array of shape (R, window_size), noise realizations
+    :param window_size: number of samples per window
+    :param hop: number of samples between the starts of two consecutive windows, samples covered by no window are
+        kept as they are
+    :param windows_per_job: number of windows deglitched jointly by a job, see deglitch_windows
+    :param n_jobs: number of processes, jobs run in this process if 1
+    :param detection_quantile: quantile of the noise realization scores above which a window is glitched
+    :param taper_alpha: fraction of the Tukey taper of each window inside the cosine lobes
+    :param output_path: if not None, a .npy file the deglitched record is written in as jobs complete
+    :param warm_start: start each window from the estimate of the previous overlapping window, if glitched
+    :param lbfgs_history: with warm_start, also carry the L-BFGS curvature history from one window to the next,
+        requires method='torch-lbfgs'
+    :param generated_dir: the directory in which the generated dirs of the jobs and the noise cache are located
+    :param exp_name: experience name, prefix of the job names
+    :param kwargs: passed to generate, e.g. J, Q, it, tol_optim, cuda
+    :return: the deglitched record of shape (T, ) and a boolean array of the windows detected as glitched
+    """
+    if x.ndim != 1:
+        raise ValueError("The record should be of shape (T, ).")
+    if nks.shape[-1] != window_size:
+        raise ValueError(f"Noise realizations should be of size {window_size}.")
+    if warm_start and windows_per_job != 1:
+        raise ValueError("Warm started windows are deglitched one after the other, windows_per_job should be 1.")
+    if lbfgs_history and not warm_start:
+        raise ValueError("The L-BFGS history is carried by warm start.")
+    T = x.shape[-1]
+    if generated_dir is None:
+        generated_dir = Path(__file__).parents[0] / '_cached_dir'
+    exp_name = exp_name or 'deglitch'
+
+    x_windows = windows(x, window_size, hop, 0)
+    starts = window_starts(T, window_size, hop, 0)
+    tapers = window_tapers(T, window_size, hop, 0, taper_alpha)
+    glitched = glitch_score(x_windows) > np.quantile(glitch_score(nks), detection_quantile)
+
+    if output_path is None:
+        x_out = np.zeros_like(x)
+    else:
+        x_out = np.lib.format.open_memmap(output_path, mode='w+', dtype=x.dtype, shape=x.shape)
+    covered = np.zeros(T, dtype=bool)
+    for start in starts:
+        covered[start:start + window_size] = True
+    x_out[~covered] = x[~covered]
+
+    def add(idces, x_hat):
+        for i, x_hat_i in zip(idces, x_hat):
+            x_out[starts[i]:starts[i] + window_size] += tapers[i] * x_hat_i
+        if output_path is not None:
+            x_out.flush()
+
+    add(np.flatnonzero(~glitched), x_windows[~glitched])
+
+    idces = np.flatnonzero(glitched)
+    cache_dir = Path(generated_dir) / f"{exp_name}_noise_cache"
+    if warm_start:
+        # runs of adjacent overlapping windows
+        breaks = np.flatnonzero(np.diff(idces) > 1) + 1 if hop < window_size else np.arange(1, idces.size)
+        jobs = [job for job in np.split(idces, breaks) if job.size > 0]
+        job_fn = deglitch_chain
+        job_kwargs = [{
+            'x': x_windows[job],
+            'starts': starts[job],
+            'nks': nks,
+            'exp_name': f"{exp_name}_warm",
+            'lbfgs_history': Path(generated_dir) / f"{exp_name}_warm_{starts[job[0]]}_lbfgs.pt"
+            if lbfgs_history else None,
+            'cache_dir': cache_dir,
+            'generated_dir': generated_dir,
+            **kwargs
+        } for job in jobs]
+    else:
+        jobs = [idces[i:i + windows_per_job] for i in range(0, idces.size, windows_per_job)]
+        job_fn = deglitch_windows
+        job_kwargs = [{
+            'x': x_windows[job],
+            'nks': nks,
+            'cache_dir': cache_dir,
+            'generated_dir': generated_dir,
+            'exp_name': f"{exp_name}_{starts[job[0]]}",
+            **kwargs
+        } for job in jobs]
+    print(f"Deglitching {idces.size}/{starts.size} windows in {len(jobs)} jobs.")
+
+    if n_jobs == 1:
+        for job, kw in zip(jobs, job_kwargs):
+            add(job, job_fn(**kw))
+    else:
+        # torch does not support fork after its threads are started
+        with ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(job_fn, **kw): job for job, kw in zip(jobs, job_kwargs)}
+            for future in as_completed(futures):
+                add(futures[future], future.result())
+
+    return x_out, glitched
+
+
 ##################
 # VIZUALIZE
 ##################
@@ -1266,6 +2017,51 @@ COLORS = [
 ] + ['orchid'] * 20
 
 
+def timing_summary(generated_dir=None):
+    """ Where time is spent in the profiled generations cached in generated_dir, one row per trajectory.
+
+    Times are totals in seconds: forward, loss and backward passes, host-device copies, optimizer i.e. time spent
+    between evaluations outside of the callback (e.g. line search), and within the callback: loss diagnostics,
+    checkpointing and the rest of the callback. Syntheses solved jointly in a batch are each attributed their share of
+    the time of the batch.
+
+    :param generated_dir: the directory in which generated dirs are located, as given to generate
+    :return: a pandas DataFrame indexed by (generated dir, trajectory)
+    """
+    if generated_dir is None:
+        generated_dir = Path(__file__).parents[0] / '_cached_dir'
+    rows = []
+    for path in sorted(Path(generated_dir).glob('*_logs/*.jsonl')):
+        with open(path) as f:
+            records = pd.DataFrame([json.loads(line) for line in f])
+        # a run may stop before its first iteration, logs written before batching have no share
+        times = ['forward', 'loss', 'backward', 'copy', 'outside', 'callback', 'diagnostics', 'checkpoint']
+        records = records.reindex(columns=records.columns.union(['type', 'n_syntheses'] + times))
+        records[times] = records[times].fillna(0.0).div(records['n_syntheses'].fillna(1), axis=0)
+        evals, iters = records[records['type'] == 'eval'], records[records['type'] == 'iter']
+        callback = iters['callback'].sum()
+        diagnostics, checkpoint = iters['diagnostics'].sum(), iters['checkpoint'].sum()
+        rows.append({
+            'dir': path.parent.name[:-len('_logs')],
+            'trajectory': path.stem,
+            'nit': len(iters),
+            'nfev': len(evals),
+            'forward': evals['forward'].sum(),
+            'loss': evals['loss'].sum(),
+            'backward': evals['backward'].sum(),
+            'copy': evals['copy'].sum(),
+            'optimizer': evals['outside'].sum() - callback,
+            'diagnostics': diagnostics,
+            'checkpoint': checkpoint,
+            'callback': callback - diagnostics - checkpoint
+        })
+    df = pd.DataFrame(rows, columns=['dir', 'trajectory', 'nit', 'nfev', 'forward', 'loss', 'backward', 'copy',
+                                     'optimizer', 'diagnostics', 'checkpoint', 'callback'])
+    df['total'] = df[['forward', 'loss', 'backward', 'copy', 'optimizer', 'diagnostics', 'checkpoint',
+                      'callback']].sum(axis=1)
+    return df.set_index(['dir', 'trajectory'])
+
+
 def bootstrap_variance_complex(x, n_points, n_samples):
     """ Estimate variance of tensor x along last axis using bootstrap method. """
     # sample data uniformly
@@ -4,5 +4,7 @@ from .described_tensor import *
 from .moment_layers import *
 from .scale_indexer import *
 from .solver import *
+from .lbfgs import *
+from .stochastic import *
 from .layers_basics import *
 from .layers_time import *
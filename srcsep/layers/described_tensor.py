@@ -60,8 +60,7 @@ class Description(pd.DataFrame):
     def reduce(self, mask: Optional[np.ndarray] = None, **kwargs) -> Description:
         """ Return the sub Description induced by mask or kwargs. """
         mask = self.where(**kwargs) if mask is None else mask
-        df = super(Description, self).copy()
-        return Description(data=df[mask])
+        return Description(data=self[mask])
 
     def clone(self) -> Description:
         return Description(self.copy())
@@ -148,11 +147,22 @@ class DescribedTensor:
         """ The number of coefficients. """
         return self.descri.size()
 
+    @staticmethod
+    def take(y: torch.Tensor, idx: np.ndarray, dim: int = 1) -> torch.Tensor:
+        """ Index y along dim, contiguous indices give a view through narrow, others go through index_select. """
+        if idx.size > 0 and idx[-1] - idx[0] + 1 == idx.size:
+            return y.narrow(dim, int(idx[0]), int(idx.size))
+        return y.index_select(dim, torch.from_numpy(idx).to(y.device))
+
+    def where(self, **kwargs) -> np.ndarray:
+        """ Return the mask of coefficients satisfying kwargs conditions. """
+        return self.descri.where(**kwargs)
+
     def select(self, mask: Optional[np.ndarray[bool]] = None, pivot: Optional[str] = None, **kwargs) -> torch.tensor:
         """ Select tensor based on its description. """
         if pivot is None:
-            mask = self.descri.where(**kwargs) if mask is None else mask
-            return self.y[:, mask, ...]
+            mask = self.where(**kwargs) if mask is None else mask
+            return self.take(self.y, np.flatnonzero(mask))
         out_non_pivot = self.reduce(**kwargs)
         possible_values = np.unique(out_non_pivot.descri.to_array(pivot))
         d = OrderedDict({val: [] for val in possible_values})
@@ -161,10 +171,10 @@ class DescribedTensor:
         return torch.stack([out_non_pivot.y[:, val, ...] for val in d.values()])
 
     def reduce(self, mask: Optional[np.ndarray[bool]] = None, b: Optional[int] = None, **kwargs) -> DescribedTensor:
-        """ Return a subtensor along with its description. """
-        mask = self.descri.where(**kwargs) if mask is None else mask
-        reduced_b = self.y if b is None else self.y[b:b+1, ...]
-        return DescribedTensor(self.x, reduced_b[:, mask, ...], self.descri.reduce(mask), self.past)
+        """ Return a subtensor along with its description, as a lazy read-only view on self, see
+        DescribedTensorView. """
+        mask = self.where(**kwargs) if mask is None else mask
+        return DescribedTensorView(self, np.flatnonzero(mask), b)
 
     def copy(self) -> DescribedTensor:
         """ Return a copy of self. """
@@ -229,3 +239,64 @@ class DescribedTensor:
 
     def __str__(self) -> str:
         return self.descri.__str__()
+
+
+
+class DescribedTensorView(DescribedTensor):
+    """ A lazy sub-tensor of a DescribedTensor. It holds the base described tensor and the indices of the selected
+    coefficients, y and its description are only materialized when accessed. Contiguous selections are views on the
+    base tensor (no copy), a selection of all the coefficients shares the base description.
+
+    A view is read-only: writing in place in its y or description writes in the base, use copy() first. """
+    def __init__(self,
+                 base: DescribedTensor,
+                 idx: np.ndarray,
+                 b: Optional[int] = None) -> None:
+        self.base, self.idx, self.b = base, idx, b
+        self.x = base.x
+        self.past = base.past
+        self._y, self._descri = None, None
+
+    @property
+    def y(self) -> torch.Tensor:
+        if self._y is None:
+            y = self.base.y if self.b is None else self.base.y.narrow(0, self.b, 1)
+            self._y = y if self.idx.size == self.base.size() else self.take(y, self.idx)
+        return self._y
+
+    @y.setter
+    def y(self, value: torch.Tensor) -> None:
+        self._y = value
+
+    @property
+    def descri(self) -> Description:
+        if self._descri is None:
+            if self.idx.size == self.base.size():
+                self._descri = self.base.descri
+            else:
+                self._descri = Description(data=self.base.descri.iloc[self.idx])
+        return self._descri
+
+    @descri.setter
+    def descri(self, value: Description) -> None:
+        self._descri = value
+
+    def size(self) -> int:
+        """ The number of coefficients. """
+        return self.idx.size
+
+    def where(self, **kwargs) -> np.ndarray:
+        """ Return the mask of coefficients satisfying kwargs conditions, computed on the base description if self
+        has not been materialized. """
+        if self._descri is not None:
+            return self._descri.where(**kwargs)
+        return self.base.where(**kwargs)[self.idx]
+
+    def reduce(self, mask: Optional[np.ndarray[bool]] = None, b: Optional[int] = None, **kwargs) -> DescribedTensor:
+        """ Return a subtensor along with its description, as a lazy view on the base tensor. """
+        if self._y is not None:
+            return super(DescribedTensorView, self).reduce(mask, b, **kwargs)
+        mask = self.where(**kwargs) if mask is None else mask
+        if self.b is not None:
+            b = self.b if b is None else self.b + b
+        return DescribedTensorView(self.base, self.idx[mask], b)
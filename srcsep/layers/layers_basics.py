@@ -59,13 +59,18 @@ class ChunkedModuleDeglitching(nn.Module):
         self.module = module
         self.batch_split = np.array_split(np.arange(self.module.nks.shape[0]), self.nchunks)
 
-    def forward(self, x: torch.tensor, i_chunk: Optional[int] = None) -> DescribedTensor:
+    def forward(self, x: torch.tensor, i_chunk: Optional[int] = None, bs: Optional[np.ndarray] = None
+                ) -> DescribedTensor:
         """
         Chunked forward on the batch dimension.
 
         :param x: 1 x ... tensor
+        :param i_chunk: if not None, only computes this chunk
+        :param bs: if not None, only computes on these noise realizations
         :return:
         """
+        if bs is not None:
+            return self.module(x, bs)
         if i_chunk is None:
             Rxs = [self.module(x, bs) for bs in self.batch_split]
             return DescribedTensor(x=None, y=torch.cat([Rx.y for Rx in Rxs]), descri=Rxs[-1].descri)
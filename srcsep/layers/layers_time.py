@@ -77,13 +77,10 @@ class Wavelet(nn.Module):
         if self.layer_r == 1:
             return np.array([(0, j) for j in range(self.sc_idxer.JQ(r=1) + 1)])
 
-        pairs = []
-        for path in self.sc_idxer.sc_paths[self.layer_r - 1]:
-            parent_path = path[:-1]
-            idx = [i for i, p in enumerate(self.sc_idxer.sc_paths[self.layer_r - 2]) if (p == parent_path).all()][0]
-            pairs.append((idx, path[-1]))
-
-        pairing = np.array(pairs)
+        # each path is paired with the index of its parent path at previous order
+        parent_idces = self.sc_idxer.parent_idces[self.layer_r - 1]
+        last_js = self.sc_idxer.sc_paths[self.layer_r - 1][:, -1]
+        pairing = np.stack([parent_idces, last_js], axis=1)
 
         return pairing
 
@@ -101,3 +98,55 @@ class Wavelet(nn.Module):
         x_filt = self.Pad.unpad(ifft(x_filt_hat))
 
         return x_filt
+
+
+class FourierPreconditioner(nn.Module):
+    """ Reparameterization x = F^{-1}(s F z) of signals of size T by orthonormal real Fourier coefficients, scaled by
+    a spectral profile s. With s the square root of the wavelet power spectrum, the optimization variable has
+    scale-normalized coefficients. """
+    def __init__(self, T: int, scale: torch.tensor):
+        """
+        :param T: number of time samples
+        :param scale: (...) x (T//2+1) tensor, the profile s on positive frequencies
+        """
+        super(FourierPreconditioner, self).__init__()
+        self.T = T
+
+        # interior frequencies count twice in the energy of x, weighting them makes the transform orthonormal
+        weight = torch.full((T // 2 + 1, ), 2 ** -0.5, dtype=scale.dtype)
+        weight[0] = 1.0
+        if T % 2 == 0:
+            weight[-1] = 1.0
+        self.register_buffer('weight', scale * weight)
+
+    @classmethod
+    def from_power_spectrum(cls, W: Wavelet, sigma2: torch.tensor, eps: float = 1e-3):
+        """ The profile s(omega)^2 is the average of the wavelet power spectrum sigma2 weighted by |psi_hat(omega)|^2,
+        normalized to a unit mean. Frequencies seen by no filter get the mean power.
+
+        :param W: first wavelet layer
+        :param sigma2: 1 x N x J tensor, power spectrum E{|Wx|^2} along the filters of W, low pass included
+        """
+        T = W.T // 2
+        # the filters are defined on the padded time axis of size 2T
+        sigma2 = sigma2.real
+        psi2 = W.filt_hat.detach()[:, ::2][:, :T // 2 + 1].to(sigma2).pow(2.0)
+        scale2 = (sigma2 @ psi2 + eps * sigma2.mean(-1, keepdim=True)) / (psi2.sum(0) + eps)
+        scale2 /= scale2.mean(-1, keepdim=True)
+        return cls(T, scale2.pow(0.5))
+
+    def synthesis(self, z: torch.tensor) -> torch.tensor:
+        """ The signal x from the variable z.
+
+        :param z: B x N x (T//2+1) x 2 tensor
+        :return: B x N x T tensor
+        """
+        return torch.fft.irfft(torch.view_as_complex(z.contiguous()) * self.weight, n=self.T, norm='ortho')
+
+    def analysis(self, x: torch.tensor) -> torch.tensor:
+        """ The variable z from the signal x, inverse of synthesis.
+
+        :param x: B x N x T tensor
+        :return: B x N x (T//2+1) x 2 tensor
+        """
+        return torch.view_as_real(torch.fft.rfft(x, norm='ortho') / self.weight)
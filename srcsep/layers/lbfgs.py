@@ -0,0 +1,227 @@
+""" A L-BFGS optimizer running on torch tensors. """
+from typing import *
+import torch
+
+
+def cubic_interpolate(x1: float, f1: float, g1: float,
+                      x2: float, f2: float, g2: float,
+                      bounds: Optional[Tuple[float, float]] = None) -> float:
+    """ Minimizer of the cubic interpolating f and its derivative g at x1 and x2, clipped to bounds. """
+    xmin_bound, xmax_bound = bounds if bounds is not None else (min(x1, x2), max(x1, x2))
+    d1 = g1 + g2 - 3 * (f1 - f2) / (x1 - x2)
+    d2_square = d1 ** 2 - g1 * g2
+    if d2_square >= 0:
+        d2 = d2_square ** 0.5
+        if x1 <= x2:
+            min_pos = x2 - (x2 - x1) * ((g2 + d2 - d1) / (g2 - g1 + 2 * d2))
+        else:
+            min_pos = x1 - (x1 - x2) * ((g1 + d2 - d1) / (g1 - g2 + 2 * d2))
+        return min(max(min_pos, xmin_bound), xmax_bound)
+    return (xmin_bound + xmax_bound) / 2.
+
+
+class LBFGS:
+    """ Limited-memory BFGS with a strong Wolfe line search. The iterate, the gradients and the curvature history stay
+    on the device of x0, only the scalars needed by the line search are brought back to host.
+
+    Stopping rules and exit messages follow scipy L-BFGS-B: maxiter, maxfun, gtol on the max absolute gradient and
+    ftol on the relative reduction of the loss. The callback is called on the iterate after each iteration.
+    """
+    def __init__(self,
+                 fun: Callable[[torch.Tensor], Tuple[torch.Tensor, torch.Tensor]],
+                 history_size: int = 10,
+                 ftol: float = 1e-24,
+                 gtol: float = 1e-24,
+                 c1: float = 1e-4,
+                 c2: float = 0.9,
+                 max_ls: int = 25,
+                 tolerance_change: float = 1e-12) -> None:
+        self.fun = fun  # x -> (loss, gradient), x being a flat tensor
+        self.history_size = history_size
+        self.ftol, self.gtol = ftol, gtol
+        self.c1, self.c2, self.max_ls = c1, c2, max_ls
+        self.tolerance_change = tolerance_change
+
+        self.old_s, self.old_y, self.rho = [], [], []  # curvature history
+        self.nit, self.nfev = 0, 0
+
+    def state_dict(self) -> Dict:
+        """ The optimizer state: curvature history and counters. """
+        return {'old_s': self.old_s, 'old_y': self.old_y, 'rho': self.rho, 'nit': self.nit, 'nfev': self.nfev}
+
+    def load_state_dict(self, state: Dict, device: Optional[torch.device] = None) -> None:
+        self.old_s = [s.to(device) for s in state['old_s']]
+        self.old_y = [y.to(device) for y in state['old_y']]
+        self.rho = list(state['rho'])
+        self.nit, self.nfev = state['nit'], state['nfev']
+
+    def evaluate(self, x: torch.Tensor) -> Tuple[float, torch.Tensor]:
+        self.nfev += 1
+        f, g = self.fun(x)
+        return float(f), g
+
+    def update_history(self, s: torch.Tensor, y: torch.Tensor) -> None:
+        """ Store the pair (s, y) if it satisfies the curvature condition. """
+        ys = float(y @ s)
+        if ys > 1e-10:
+            if len(self.old_s) == self.history_size:
+                self.old_s.pop(0)
+                self.old_y.pop(0)
+                self.rho.pop(0)
+            self.old_s.append(s)
+            self.old_y.append(y)
+            self.rho.append(1.0 / ys)
+
+    def direction(self, g: torch.Tensor) -> torch.Tensor:
+        """ Two-loop recursion computing -H g with H the inverse Hessian approximation. """
+        if len(self.old_s) == 0:
+            return -g
+        q = g.clone()
+        alphas = []
+        for s, y, rho in zip(reversed(self.old_s), reversed(self.old_y), reversed(self.rho)):
+            alpha = rho * (s @ q)
+            q -= alpha * y
+            alphas.append(alpha)
+        gamma = 1.0 / (self.rho[-1] * (self.old_y[-1] @ self.old_y[-1]))
+        r = gamma * q
+        for s, y, rho, alpha in zip(self.old_s, self.old_y, self.rho, reversed(alphas)):
+            beta = rho * (y @ r)
+            r += s * (alpha - beta)
+        return -r
+
+    def line_search(self, x: torch.Tensor, f: float, g: torch.Tensor, d: torch.Tensor, t: float, gtd: float
+                    ) -> Tuple[float, float, torch.Tensor]:
+        """ Find a step t along d satisfying the strong Wolfe conditions: bracketing phase then zoom phase.
+
+        :return: the step, the loss and the gradient at x + t d, the step is 0 if no decrease was found
+        """
+        d_norm = float(d.abs().max())
+        f_new, g_new = self.evaluate(x + t * d)
+        gtd_new = float(g_new @ d)
+
+        t_prev, f_prev, g_prev, gtd_prev = 0., f, g, gtd
+        bracket = None
+        ls_iter = 0
+        while ls_iter < self.max_ls:
+            if f_new > f + self.c1 * t * gtd or (ls_iter > 0 and f_new >= f_prev):
+                bracket = [t_prev, t], [f_prev, f_new], [g_prev, g_new], [gtd_prev, gtd_new]
+                break
+            if abs(gtd_new) <= -self.c2 * gtd:
+                return t, f_new, g_new
+            if gtd_new >= 0:
+                bracket = [t_prev, t], [f_prev, f_new], [g_prev, g_new], [gtd_prev, gtd_new]
+                break
+
+            # extrapolate
+            t_next = cubic_interpolate(t_prev, f_prev, gtd_prev, t, f_new, gtd_new,
+                                       bounds=(t + 0.01 * (t - t_prev), t * 10))
+            t_prev, f_prev, g_prev, gtd_prev = t, f_new, g_new, gtd_new
+            t = t_next
+            f_new, g_new = self.evaluate(x + t * d)
+            gtd_new = float(g_new @ d)
+            ls_iter += 1
+
+        if bracket is None:
+            return (t, f_new, g_new) if f_new < f else (0., f, g)
+
+        ts, fs, gs, gtds = bracket
+        low, high = (0, 1) if fs[0] <= fs[1] else (1, 0)
+        while ls_iter < self.max_ls and abs(ts[1] - ts[0]) * d_norm >= self.tolerance_change:
+            t = cubic_interpolate(ts[0], fs[0], gtds[0], ts[1], fs[1], gtds[1])
+
+            # make sure the trial step is not too close to the bracket ends
+            t_min, t_max = min(ts), max(ts)
+            eps = 0.1 * (t_max - t_min)
+            if min(t_max - t, t - t_min) < eps:
+                t = t_max - eps if abs(t - t_max) < abs(t - t_min) else t_min + eps
+
+            f_new, g_new = self.evaluate(x + t * d)
+            gtd_new = float(g_new @ d)
+            ls_iter += 1
+
+            if f_new > f + self.c1 * t * gtd or f_new >= fs[low]:
+                ts[high], fs[high], gs[high], gtds[high] = t, f_new, g_new, gtd_new
+            else:
+                if abs(gtd_new) <= -self.c2 * gtd:
+                    return t, f_new, g_new
+                if gtd_new * (ts[high] - ts[low]) >= 0:
+                    ts[high], fs[high], gs[high], gtds[high] = ts[low], fs[low], gs[low], gtds[low]
+                ts[low], fs[low], gs[low], gtds[low] = t, f_new, g_new, gtd_new
+            low, high = (0, 1) if fs[0] <= fs[1] else (1, 0)
+
+        if fs[low] < f:
+            return ts[low], fs[low], gs[low]
+        return 0., f, g
+
+    def minimize(self,
+                 x0: torch.Tensor,
+                 maxiter: int,
+                 maxfun: int,
+                 callback: Optional[Callable[[torch.Tensor], None]] = None) -> Dict:
+        """ Minimize fun starting from x0.
+
+        :param x0: a flat tensor
+        :param maxiter: maximum number of iterations
+        :param maxfun: maximum number of function evaluations
+        :param callback: called on the iterate after each iteration
+        :return: a dict with keys fun, x, nit, nfev, message as scipy.optimize.minimize
+        """
+        x = x0.detach().clone()
+        f, g = self.evaluate(x)
+        nit0 = self.nit
+
+        while True:
+            if float(g.abs().max()) <= self.gtol:
+                msg = "CONVERGENCE: NORM_OF_PROJECTED_GRADIENT_<=_PGTOL"
+                break
+
+            d = self.direction(g)
+            gtd = float(g @ d)
+            if gtd > -self.tolerance_change:  # not a descent direction, restart from steepest descent
+                self.old_s, self.old_y, self.rho = [], [], []
+                d = -g
+                gtd = float(g @ d)
+
+            t = min(1., 1. / float(g.abs().sum())) if len(self.old_s) == 0 else 1.
+            t, f_new, g_new = self.line_search(x, f, g, d, t, gtd)
+            if t == 0.:
+                msg = "ABNORMAL_TERMINATION_IN_LNSRCH"
+                break
+
+            s = t * d
+            self.update_history(s, g_new - g)
+            x = x + s
+            f_old, f, g = f, f_new, g_new
+            self.nit += 1
+
+            if callback is not None:
+                callback(x)
+
+            if self.nit - nit0 >= maxiter:
+                msg = "STOP: TOTAL NO. OF ITERATIONS REACHED LIMIT"
+                break
+            if self.nfev >= maxfun:
+                msg = "STOP: TOTAL NO. OF F,G EVALUATIONS EXCEEDS LIMIT"
+                break
+            if (f_old - f) / max(abs(f_old), abs(f), 1.) <= self.ftol:
+                msg = "CONVERGENCE: REL_REDUCTION_OF_F_<=_FACTR*EPSMCH"
+                break
+
+        return {'fun': f, 'x': x, 'nit': self.nit - nit0, 'nfev': self.nfev, 'message': msg}
+
+
+def shift_state(state: Dict, shift: int, T: int) -> Dict:
+    """ The state of an optimization on signals of size T, for a window translated by shift samples along time, to warm
+    start the optimization on the next overlapping window. Curvature pairs are translated, samples entering the window
+    being zero, pairs that no longer satisfy the curvature condition are dropped and counters are reset. """
+    shift = min(shift, T)
+    old_s, old_y, rho = [], [], []
+    for s, y in zip(state['old_s'], state['old_y']):
+        s, y = (torch.cat([v.reshape(-1, T)[:, shift:], v.new_zeros(v.numel() // T, shift)], dim=1).reshape(-1)
+                for v in (s, y))
+        ys = float(y @ s)
+        if ys > 1e-10:
+            old_s.append(s)
+            old_y.append(y)
+            rho.append(1.0 / ys)
+    return {'old_s': old_s, 'old_y': old_y, 'rho': rho, 'nit': 0, 'nfev': 0}
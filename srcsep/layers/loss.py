@@ -4,24 +4,64 @@ import numpy as np
 import torch.nn as nn
 import torch
 
-from srcsep.layers.described_tensor import DescribedTensor
+from srcsep.layers.described_tensor import Description, DescribedTensor
 
 
-class MSELossScat(nn.Module):
-    """ Implements l2 norm on the scattering coefficients or scattering covariances. """
-    def __init__(self):
-        super(MSELossScat, self).__init__()
-        self.max_gap, self.mean_gap_pct, self.max_gap_pct = {}, {}, {}  # tracking
+class GapTrackingLoss(nn.Module):
+    """ Keeps the last gap computed along with its target. Gap statistics used for tracking are only computed from it
+    when accessed.
 
-    def compute_gap(self, input: Optional[DescribedTensor], target: DescribedTensor, weights):
+    A loss can be bound to a fixed target, see bind, in which case the target is given as None. """
+    def __init__(self):
+        super(GapTrackingLoss, self).__init__()
+        self.tracked = None  # (gap, target) of the last call
+        self.gap_stats = None
+        self.bound_c_types = None
+
+    def bind(self, target: DescribedTensor) -> None:
+        """ Precompute everything that only depends on the target: the target itself and, for the gap statistics,
+        the indices of the coefficients of each c_type that are not too small along with their absolute values. """
+        self.register_buffer('target_y', target.y)
+
+        y = target.y[:, :, 0]
+        mask_small = (torch.abs(y.mean(0)) < 0.01).cpu().numpy()
+        self.bound_c_types = np.unique(target.descri['c_type']).tolist()
+        idces = [np.flatnonzero(target.descri.where(c_type=c_type) & ~mask_small) for c_type in self.bound_c_types]
+        idx = torch.from_numpy(np.concatenate(idces)).to(y.device)
+        segments = torch.from_numpy(np.repeat(np.arange(len(idces)), [i.size for i in idces])).to(y.device)
+        abs_target = torch.abs(y[:, idx])
+        counts = torch.bincount(segments, minlength=len(idces)).to(abs_target.dtype) * y.shape[0]
+
+        self.register_buffer('bound_idx', idx)
+        self.register_buffer('bound_segments', segments)
+        self.register_buffer('bound_abs_target', abs_target)
+        self.register_buffer('bound_mean_abs_target',
+                             torch.zeros_like(counts).index_add(0, segments, abs_target.sum(0)) / counts)
+
+    def compute_gap(self, input: Optional[Union[DescribedTensor, torch.Tensor]], target: Optional[DescribedTensor],
+                    weights):
+        target_y = self.target_y if target is None else target.y
         if input is None:
-            gap = torch.zeros_like(target.y) - target.y
+            gap = torch.zeros_like(target_y) - target_y
         else:
-            gap = input.y - target.y
+            gap = (input if torch.is_tensor(input) else input.y) - target_y
         gap = gap[:, :, 0]
 
         gap = gap if weights is None else weights.unsqueeze(-1) * gap
 
+        self.tracked = gap.detach(), target
+        self.gap_stats = None
+
+        return gap
+
+    def compute_gap_statistics(self, gap: torch.Tensor, target: Optional[DescribedTensor]
+                               ) -> Tuple[Dict, Dict, Dict]:
+        """ Max gap, mean relative gap and max relative gap per coefficient type. """
+        if target is None:
+            return self.compute_bound_gap_statistics(gap)
+
+        max_gap, mean_gap_pct, max_gap_pct = {}, {}, {}  # tracking
+
         for c_type in np.unique(target.descri['c_type']):
             # discard very small coefficients
             mask_ctype = target.descri.where(c_type=c_type)
@@ -29,19 +69,66 @@ class MSELossScat(nn.Module):
             mask = mask_ctype & ~mask_small
 
             if mask.sum() == 0:
-                self.max_gap[c_type] = self.mean_gap_pct[c_type] = self.max_gap_pct[c_type] = 0.0
+                max_gap[c_type] = mean_gap_pct[c_type] = max_gap_pct[c_type] = 0.0
                 continue
 
-            self.max_gap[c_type] = torch.max(torch.abs(gap[:, mask])).item()
+            max_gap[c_type] = torch.max(torch.abs(gap[:, mask])).item()
 
-            mean_gap_pct = torch.abs(gap[:, mask]).mean()
-            mean_gap_pct /= torch.abs(target.select(mask)[:, :, 0]).mean()
-            self.mean_gap_pct[c_type] = mean_gap_pct.item()
+            mean_gap_pct_ctype = torch.abs(gap[:, mask]).mean()
+            mean_gap_pct_ctype /= torch.abs(target.select(mask)[:, :, 0]).mean()
+            mean_gap_pct[c_type] = mean_gap_pct_ctype.item()
 
-            max_gap_pct = torch.max(torch.abs(gap[:, mask] / target.select(mask)[:, :, 0]))
-            self.max_gap_pct[c_type] = max_gap_pct.item()
+            max_gap_pct_ctype = torch.max(torch.abs(gap[:, mask] / target.select(mask)[:, :, 0]))
+            max_gap_pct[c_type] = max_gap_pct_ctype.item()
 
-        return gap
+        return max_gap, mean_gap_pct, max_gap_pct
+
+    def compute_bound_gap_statistics(self, gap: torch.Tensor) -> Tuple[Dict, Dict, Dict]:
+        """ Same as compute_gap_statistics for the bound target, with a single transfer to host. """
+        abs_gap = torch.abs(gap[:, self.bound_idx])
+        zeros = torch.zeros(len(self.bound_c_types), dtype=abs_gap.dtype, device=abs_gap.device)
+
+        max_gap = zeros.scatter_reduce(0, self.bound_segments, abs_gap.amax(0), 'amax', include_self=False)
+        counts = torch.bincount(self.bound_segments, minlength=zeros.shape[0]).to(abs_gap.dtype) * gap.shape[0]
+        mean_gap = zeros.index_add(0, self.bound_segments, abs_gap.sum(0)) / counts
+        max_gap_pct = zeros.scatter_reduce(0, self.bound_segments, (abs_gap / self.bound_abs_target).amax(0), 'amax',
+                                           include_self=False)
+
+        stats = torch.stack([max_gap, mean_gap / self.bound_mean_abs_target, max_gap_pct])
+        stats = torch.nan_to_num(stats, nan=0.0).cpu().numpy()  # c_types without coefficient
+
+        return tuple({c_type: float(value) for c_type, value in zip(self.bound_c_types, row)} for row in stats)
+
+    def gap_statistics(self) -> Tuple[Dict, Dict, Dict]:
+        """ Gap statistics on the last gap computed. """
+        if self.tracked is None:
+            return {}, {}, {}
+        if self.gap_stats is None:
+            self.gap_stats = self.compute_gap_statistics(*self.tracked)
+        return self.gap_stats
+
+    @property
+    def max_gap(self) -> Dict:
+        return self.gap_statistics()[0]
+
+    @property
+    def mean_gap_pct(self) -> Dict:
+        return self.gap_statistics()[1]
+
+    @property
+    def max_gap_pct(self) -> Dict:
+        return self.gap_statistics()[2]
+
+
+class MSELossScat(GapTrackingLoss):
+    """ Implements l2 norm on the scattering coefficients or scattering covariances. """
+    def __init__(self, target: Optional[DescribedTensor] = None):
+        """
+        :param target: if not None, the loss is bound to this target and called with target None
+        """
+        super(MSELossScat, self).__init__()
+        if target is not None:
+            self.bind(target)
 
     def forward(self, input, target, weights_gap, weights_l2):
         """ Computes l2 norm. """
@@ -53,73 +140,78 @@ class MSELossScat(nn.Module):
         return loss
 
 
-class DeglitchingLoss(nn.Module):
-    """ Computes Ave_i |phi(nt) - phi(ni)|^2 + |phi(x-nt,nt)|^2 """
-    def __init__(self, phi_x, phi_nks, std_nks, std_x_nks, std_cross, x_loss_w=1.0, indep_loss_w=1.0):
+class DeglitchingLoss(GapTrackingLoss):
+    """ Computes Ave_i |phi(nt) - phi(ni)|^2 + |phi(x-nt,nt)|^2
+
+    With several windows, the loss is the average of the independent losses of each window, which are kept in
+    window_losses. """
+    def __init__(self, phi_x, phi_nks, std_nks, std_x_nks, std_cross, descri: Description,
+                 x_loss_w=1.0, indep_loss_w=1.0):
+        """
+        :param phi_x: representation of the W windows
+        :param std_x_nks: W x K tensor
+        :param std_cross: two W x K' tensors
+        :param descri: description of the input, i.e. of the output of ModelDeglitching, from which the indices of
+            each loss term are computed once
+        """
         super(DeglitchingLoss, self).__init__()
         self.phi_x, self.phi_nks = phi_x, phi_nks  # fixed representations used in the loss
         self.std_nks, self.std_x_nks, self.std_cross = std_nks, std_x_nks, std_cross  # stds used to weight l2 norm
 
-        self.max_gap, self.mean_gap_pct, self.max_gap_pct = {}, {}, {}  # tracking
-
         self.indep_loss_w = indep_loss_w
         self.x_loss_w = x_loss_w
 
-    def compute_gap(self, input: Optional[DescribedTensor], target: DescribedTensor, weights):
-        if input is None:
-            gap = torch.zeros_like(target.y) - target.y
-        else:
-            gap = input.y - target.y
-        gap = gap[:, :, 0]
+        self.n_windows = phi_x.y.shape[0]
+        self.window_losses = None  # loss of each window at the last call
 
-        gap = gap if weights is None else weights.unsqueeze(-1) * gap
+        # the target of the first loss term is fixed, phi(nk) for each realization then window
+        self.bind(DescribedTensor(x=None, y=phi_nks.y.repeat_interleave(self.n_windows, dim=0), descri=phi_nks.descri))
 
-        for c_type in np.unique(target.descri['c_type']):
-            # discard very small coefficients
-            mask_ctype = target.descri.where(c_type=c_type)
-            mask_small = (torch.abs(target.y[:, :, 0].mean(0)) < 0.01).cpu().numpy()
-            mask = mask_ctype & ~mask_small
-
-            if mask.sum() == 0:
-                self.max_gap[c_type] = self.mean_gap_pct[c_type] = self.max_gap_pct[c_type] = 0.0
-                continue
-
-            self.max_gap[c_type] = torch.max(torch.abs(gap[:, mask])).item()
-
-            mean_gap_pct = torch.abs(gap[:, mask]).mean()
-            mean_gap_pct /= torch.abs(target.select(mask)[:, :, 0]).mean()
-            self.mean_gap_pct[c_type] = mean_gap_pct.item()
-
-            max_gap_pct = torch.max(torch.abs(gap[:, mask] / target.select(mask)[:, :, 0]))
-            self.max_gap_pct[c_type] = max_gap_pct.item()
-
-        return gap
+        # index plan of each loss term in the input, phi(nt) and phi(x-nt+nk) are contiguous blocks
+        self.range_nt = self.contiguous_range(descri.where(deglitch_loss_term=0))
+        self.range_x_nks = self.contiguous_range(descri.where(deglitch_loss_term=1))
+        c_types = ['spars', 'ps', 'phaseenv', 'envelope']  # the coefficient type on which imposing independence
+        for name, (nl, nr) in [('idx_cross12', (0, 1)), ('idx_cross21', (1, 0))]:
+            mask = descri.where(nl=nl, nr=nr, c_type=c_types, deglitch_loss_term=2)
+            self.register_buffer(name, torch.from_numpy(np.flatnonzero(mask)))
 
     @staticmethod
-    def mse(x):
-        return torch.abs(x).pow(2.0).mean()
+    def contiguous_range(mask: np.ndarray) -> Tuple[int, int]:
+        """ Start and length of the block of coefficients selected by mask. """
+        idx = np.flatnonzero(mask)
+        if idx.size == 0 or idx[-1] - idx[0] + 1 != idx.size:
+            raise ValueError("Deglitching loss term is not a contiguous block of coefficients.")
+        return int(idx[0]), int(idx.size)
+
+    def mse(self, x):
+        """ Mean squared modulus of each window, x being ordered by realization then window. """
+        return torch.abs(x.reshape(-1, self.n_windows, x.shape[-1])).pow(2.0).mean((0, 2))
 
     def forward(self, input, target, weights_gap, weights_l2):
+        y = input.y
+
         # loss term Ave_k |phi(nt) - phi(nk)|^2
-        phi_nt = input.reduce(b=0, deglitch_loss_term=0)
-        gap1 = self.compute_gap(phi_nt, self.phi_nks, weights_gap)
+        phi_nt = y[:self.n_windows].narrow(1, *self.range_nt)
+        gap1 = self.compute_gap(phi_nt.repeat(self.target_y.shape[0] // self.n_windows, 1, 1), None, weights_gap)
         # gap1 = self.compute_gap(phi_nt, self.phi_nks.mean_batch(), weights_gap)  # an alternative
-        gap1 /= self.std_nks[None, :]
+        gap1 = gap1 / self.std_nks[None, :]  # out of place, the unweighted gap is tracked
         loss1 = self.mse(gap1)
 
         # loss term Ave_k |phi(x) - phi(x-nk+nt)|^2
-        phi_x_nks = input.reduce(deglitch_loss_term=1)
-        gap2 = self.phi_x.y[:,:,0] - phi_x_nks.y[:,:,0]
+        phi_x_nks = y.narrow(1, *self.range_x_nks)
+        gap2 = self.phi_x.y[None,:,:,0] - phi_x_nks[:,:,0].reshape(-1, *self.std_x_nks.shape)
         # gap2 = self.phi_x.y[:,:,0] - phi_x_nks.mean_batch().y[:,:,0]  # an alternative
         gap2 /= self.std_x_nks[None, :]
         loss2 = self.mse(gap2)
 
         # independence loss |phi(x-nt, nk)|^2 + |phi(nk, x-nt)|^2
-        c_types = ['spars','ps','phaseenv','envelope']  # the coefficient type on which imposing independence
-        cross12 = input.select(nl=0, nr=1,c_type=c_types,deglitch_loss_term=2)[:,:,0] / self.std_cross[0][None,:]
-        cross21 = input.select(nl=1, nr=0,c_type=c_types,deglitch_loss_term=2)[:,:,0] / self.std_cross[1][None,:]
+        cross12 = y.index_select(1, self.idx_cross12)[:,:,0].reshape(-1, *self.std_cross[0].shape) / self.std_cross[0]
+        cross21 = y.index_select(1, self.idx_cross21)[:,:,0].reshape(-1, *self.std_cross[1].shape) / self.std_cross[1]
         loss3 = 0.5 * (self.mse(cross12) + self.mse(cross21))
 
         #print('data loss:', loss1.item(), 'prior loss:', loss2.item(), 'independence loss:', loss3.item())
 
-        return loss1 + self.x_loss_w * loss2 + self.indep_loss_w * loss3
+        losses = loss1 + self.x_loss_w * loss2 + self.indep_loss_w * loss3
+        self.window_losses = losses.detach()
+
+        return losses.mean()
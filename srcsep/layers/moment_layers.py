@@ -58,6 +58,18 @@ class Order1Moments(nn.Module):
 
         return y.reshape(y.shape[0], y.shape[1], -1, y.shape[-1])
 
+    def forward_real(self, Wx_re: torch.tensor, Wx_im: torch.tensor, Wx_mod: torch.tensor
+                     ) -> Tuple[torch.tensor, torch.tensor]:
+        """ Same as forward, on the real part, imaginary part and modulus of Wx.
+
+        :return: real and imaginary parts of the B x N x K x T' output
+        """
+        y_mod = self.ave(Wx_mod[:, :, :-1, :, :])
+        y_re = torch.cat([y_mod, self.ave(Wx_re[:, :, -1:, :, :])], dim=-3)
+        y_im = torch.cat([torch.zeros_like(y_mod), self.ave(Wx_im[:, :, -1:, :, :])], dim=-3)
+
+        return tuple(y.reshape(y.shape[0], y.shape[1], -1, y.shape[-1]) for y in [y_re, y_im])
+
 
 class ScatCoefficients(nn.Module):
     """ Compute per channel (marginal) order q moments. """
@@ -179,6 +191,21 @@ class Cov(nn.Module):
 
         return y
 
+    def forward_real(self, sxl_re: torch.tensor, sxl_im: torch.tensor,
+                     sxr_re: torch.tensor, sxr_im: torch.tensor,
+                     channel_mode: Optional[str] = 'full') -> Tuple[torch.tensor, torch.tensor]:
+        """ Same as forward, on the real and imaginary parts of sxl and sxr.
+
+        :return: real and imaginary parts of the B x channels x K x T' output
+        """
+        scl, scr = self.idx_l, self.idx_r
+        nl, nr = self.get_channel_idx(sxl_re.shape[1], sxr_re.shape[1], channel_mode)
+        a, b = sxl_re[:, :, scl, 0, :][:, nl, ...], sxl_im[:, :, scl, 0, :][:, nl, ...]
+        c, d = sxr_re[:, :, scr, 0, :][:, nr, ...], sxr_im[:, :, scr, 0, :][:, nr, ...]
+
+        # (a + ib)(c - id)
+        return self.ave(a * c + b * d), self.ave(b * c - a * d)
+
 
 class CovScaleInvariant(nn.Module):
     """ Reduced representation by making covariances invariant to scaling. """
@@ -1,6 +1,6 @@
 """ A class that implements the scale paths used in the scattering transform. """
 from typing import *
-from itertools import product, chain
+from itertools import chain
 from collections import OrderedDict
 import numpy as np
 import torch
@@ -29,16 +29,25 @@ class ScatteringShape:
 
 
 class ScaleIndexer:
-    """ Implements the scale paths used in the scattering transform. """
+    """ Implements the scale paths used in the scattering transform.
+
+    Paths of order r are stored as integer arrays in lexicographic order and encoded by their mixed-radix code
+    j1 * R2 * ... * Rr + ... + j{r-1} * Rr + jr with Ro = JQ(o) + 1, so that encoding and decoding are array lookups.
+    """
     def __init__(self,
                  r: int,
                  J: List[int],
-                 Q: List[int]) -> None:
+                 Q: List[int],
+                 keep: Optional[List[np.ndarray]] = None) -> None:
         self.r, self.J, self.Q = r, J, Q
 
-        self.sc_paths = self.create_sc_paths()  # list[order] array
-        self.p_coding, self.p_decoding = self.construct_path_coding_dicts()
+        self.sc_paths, self.parent_idces = self.create_sc_paths()  # list[order] array
+        if keep is not None:
+            self.sc_paths, self.parent_idces = self.restrict_sc_paths(keep)
+        self.sc_codes = [self.encode(paths) for paths in self.sc_paths]  # list[order] array, increasing
+        self.offsets = np.cumsum([0] + [paths.shape[0] for paths in self.sc_paths])
         self.sc_idces = self.create_sc_idces()  # # list[order] array
+        self._p_coding, self._p_decoding = None, None
 
         self.low_pass_mask = self.compute_low_pass_mask()  # list[order] array
 
@@ -51,21 +60,66 @@ class ScaleIndexer:
         return (len(path) <= self.r) and \
                all(i // self.Q[order] < j // self.Q[order + 1] for order, (i, j) in enumerate(zip(path[:-1], path[1:])))
 
-    def create_sc_paths(self) -> List[np.ndarray]:
-        """ The tables j1, j2 ... j{r-1} jr for every order r. """
-        sc_paths_l = []
-        for r in range(1, self.r + 1):
-            sc_paths_r = np.array([p for p in product(*[range(self.JQ(o+1)+1) for o in range(r)]) if self.condition(p)])
-            sc_paths_l.append(sc_paths_r)
-        return sc_paths_l
+    def create_sc_paths(self) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """ The tables j1, j2 ... j{r-1} jr for every order r, along with the index of each path's parent
+        j1, j2 ... j{r-1} in the table of order r-1. Order r paths are obtained by extending admissible order r-1 paths,
+        which satisfies self.condition and keeps the lexicographic order. """
+        sc_paths_l = [np.arange(self.JQ(1) + 1)[:, None]]
+        parent_idces_l = [np.zeros(self.JQ(1) + 1, dtype=np.int64)]
+        for r in range(2, self.r + 1):
+            parents, js = sc_paths_l[-1], np.arange(self.JQ(r) + 1)
+            parent_idces = np.repeat(np.arange(parents.shape[0]), js.size)
+            js = np.tile(js, parents.shape[0])
+            admissible = parents[parent_idces, -1] // self.Q[r - 2] < js // self.Q[r - 1]
+            sc_paths_l.append(np.concatenate([parents[parent_idces[admissible]], js[admissible, None]], axis=1))
+            parent_idces_l.append(parent_idces[admissible])
+        return sc_paths_l, parent_idces_l
+
+    def restrict_sc_paths(self, keep: List[np.ndarray]) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """ Restrict the tables of paths to the paths kept at each order, keep[r-1] being a boolean mask on the order r
+        table. A path whose parent is discarded is discarded too. """
+        sc_paths_l, parent_idces_l = [], []
+        keep_prev = None
+        for paths, parent_idces, keep_r in zip(self.sc_paths, self.parent_idces, keep):
+            keep_r = np.asarray(keep_r, dtype=bool)
+            if keep_prev is not None:
+                new_idces_prev = np.cumsum(keep_prev) - 1
+                keep_r = keep_r & keep_prev[parent_idces]
+                parent_idces = new_idces_prev[parent_idces]
+            sc_paths_l.append(paths[keep_r])
+            parent_idces_l.append(parent_idces[keep_r])
+            keep_prev = keep_r
+        return sc_paths_l, parent_idces_l
 
     def create_sc_idces(self) -> List[np.ndarray]:
         """ The scale idces numerating scale paths. """
-        sc_idces_l = []
-        for r in range(1, self.r + 1):
-            sc_idces_r = np.array([self.path_to_idx(p) for p in self.sc_paths[r-1]])
-            sc_idces_l.append(sc_idces_r)
-        return sc_idces_l
+        return [np.arange(self.offsets[r-1], self.offsets[r]) for r in range(1, self.r + 1)]
+
+    def encode(self, paths: np.ndarray) -> np.ndarray:
+        """ The mixed-radix code of each row j1, j2 ... jr of a P x r array of paths. """
+        paths = np.atleast_2d(paths)
+        radices = [self.JQ(o) + 1 for o in range(1, paths.shape[-1] + 1)]
+        weights = np.array([np.prod(radices[o+1:], dtype=np.int64) for o in range(len(radices))], dtype=np.int64)
+        return paths.astype(np.int64) @ weights
+
+    def paths_to_idces(self, paths: np.ndarray) -> np.ndarray:
+        """ Return the scale indices of a P x r array of paths having same order r. """
+        paths = np.atleast_2d(paths)
+        r = paths.shape[-1]
+        if r == 0:
+            return np.zeros(paths.shape[0], dtype=np.int64)
+        codes = self.encode(paths)
+        pos = np.searchsorted(self.sc_codes[r-1], codes)
+        if (pos >= self.sc_codes[r-1].size).any() or (self.sc_codes[r-1][pos] != codes).any():
+            raise KeyError("Unrecognized scale path.")
+        return self.offsets[r-1] + pos
+
+    def idces_to_orders(self, idces: np.ndarray) -> np.ndarray:
+        """ Return the order of each scale index. """
+        idces = np.asarray(idces)
+        if (idces < 0).any() or (idces >= self.offsets[-1]).any():
+            raise KeyError("Unrecognized scale index.")
+        return np.searchsorted(self.offsets, idces, side='right')
 
     def construct_path_coding_dicts(self) -> Tuple[Dict[Tuple, int], Dict[int, Tuple]]:
         """ Construct the enumeration idx -> path. """
@@ -75,6 +129,18 @@ class ScaleIndexer:
 
         return coding, decoding
 
+    @property
+    def p_coding(self) -> Dict[Tuple, int]:
+        if self._p_coding is None:
+            self._p_coding, self._p_decoding = self.construct_path_coding_dicts()
+        return self._p_coding
+
+    @property
+    def p_decoding(self) -> Dict[int, Tuple]:
+        if self._p_decoding is None:
+            self._p_coding, self._p_decoding = self.construct_path_coding_dicts()
+        return self._p_decoding
+
     def get_all_paths(self) -> List[Tuple]:
         return list(self.p_coding.keys())
 
@@ -87,15 +153,17 @@ class ScaleIndexer:
         if len(path) > 0 and path[-1] == -1:
             i0 = np.argmax(path == -1)
             path = path[:i0]
-        return self.p_coding[tuple(path)]
+        return int(self.paths_to_idces(path[None, :])[0])
 
     def idx_to_path(self, idx: int, squeeze: Optional[bool] = True) -> Tuple[int]:
         """ Return scale path j1, j2 ... j{r-1} jr corresponding to scale index i. """
         if idx == -1:
             return tuple()
+        r = int(self.idces_to_orders(idx))
+        path = tuple(self.sc_paths[r-1][idx - self.offsets[r-1]])
         if squeeze:
-            return self.p_decoding[idx]
-        return self.p_decoding[idx] + (pd.NA, ) * (self.r - len(self.p_decoding[idx]))
+            return path
+        return path + (pd.NA, ) * (self.r - len(path))
 
     def is_low_pass(self, path: Union[Tuple, List, np.ndarray]) -> bool:
         """ Determines if the path indexed by idx is ending with a low-pass. """
@@ -106,7 +174,7 @@ class ScaleIndexer:
     def order(self, path: Union[Tuple, List, np.ndarray]) -> int:
         """ The scattering order of the path indexed by idx. """
         if isinstance(path, (int, np.integer)):
-            path = self.idx_to_path(path)
+            return int(self.idces_to_orders(path))
         return len(path)
 
     def compute_low_pass_mask(self) -> List[torch.Tensor]:
@@ -1,11 +1,13 @@
 """ Manage generation algorithm. """
 from typing import *
+from pathlib import Path
+import os
 from termcolor import colored
 from time import time
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.autograd import Variable, grad
+from torch.autograd import Variable
 
 from .described_tensor import DescribedTensor
 
@@ -18,7 +20,21 @@ class Solver(nn.Module):
                  Rxf: Optional[DescribedTensor] = None,
                  x0: Optional[np.ndarray] = None,
                  fixed_ts: Optional[np.ndarray] = None,
-                 cuda: bool = False) -> None:
+                 cuda: bool = False,
+                 profile: bool = False,
+                 cache_size: int = 4,
+                 preconditioner: Optional[nn.Module] = None,
+                 support: Optional[np.ndarray] = None) -> None:
+        """
+        :param profile: record the time spent in each phase of each evaluation in self.timings, synchronizing the
+            device at each phase boundary
+        :param cache_size: number of last evaluations kept, an evaluation at one of these points is not recomputed
+        :param preconditioner: if not None, the optimization variable is z with x = preconditioner.synthesis(z), see
+            to_variable and from_variable, gradients are taken with respect to z
+        :param support: boolean mask of size T, if not None only the time samples in the support are optimized, the
+            others being fixed to their value in x0, the optimization variable is reduced to the support, see
+            to_variable and from_variable
+        """
         super(Solver, self).__init__()
 
         self.model = model
@@ -32,17 +48,36 @@ class Solver(nn.Module):
 
         # time indices at which to put the gradient to zero
         self.fixed_ts = fixed_ts
+        if fixed_ts is not None and preconditioner is not None:
+            raise ValueError("Fixed time indices cannot be imposed on a preconditioned variable.")
+        self.preconditioner = preconditioner
+        if support is not None and (fixed_ts is not None or preconditioner is not None):
+            raise ValueError("A support cannot be combined with fixed time indices or a preconditioner.")
+        self.support = None if support is None else torch.from_numpy(np.flatnonzero(support))
 
         self.counter = 0
+        self.nfev = 0  # number of loss and gradient evaluations
+        self.nhits = 0  # number of evaluations found in the cache
+        self.cache_size = cache_size
+        self.cache = []  # (x, realization indices, loss, gradient, tracked gaps), most recently used last
         self.res = None, None
 
+        self.profile = profile
+        self.timings = []  # one record per evaluation and per iteration if profiling
+        self.toc_eval = None  # end of the last evaluation
+
         # for debug only
         self.grad_stored = []
 
+        # the signal outside of the support
+        self.x_fixed = self.x0.reshape(self.B, self.N, -1) if support is not None else None
+
         if cuda:
             self.cuda()
             if Rxf is not None:
                 Rxf = Rxf.cuda()
+            if support is not None:
+                self.support, self.x_fixed = self.support.cuda(), self.x_fixed.cuda()
 
         self.Rxf = Rxf
 
@@ -58,88 +93,189 @@ class Solver(nn.Module):
         x = Variable(x, requires_grad=requires_grad)
         return x
 
-    def joint(self, x: np.ndarray) -> Tuple[torch.tensor, torch.tensor]:
-        """ Computes the loss on current vector. """
+    def to_variable(self, x: np.ndarray) -> np.ndarray:
+        """ The flat optimization variable corresponding to signal x. """
+        if self.support is not None:
+            return x.reshape(self.B, self.N, -1)[..., self.support.cpu().numpy()].reshape(-1)
+        if self.preconditioner is None:
+            return x.reshape(-1)
+        with torch.no_grad():
+            x = torch.from_numpy(x.reshape(self.B, self.N, -1)).to(self.preconditioner.weight.device)
+            return self.preconditioner.analysis(x).cpu().numpy().reshape(-1)
+
+    def from_variable(self, z: np.ndarray) -> np.ndarray:
+        """ The flat signal corresponding to optimization variable z. """
+        if self.support is not None:
+            x = self.x_fixed.cpu().numpy().copy()
+            x[..., self.support.cpu().numpy()] = z.reshape(self.B, self.N, -1)
+            return x.reshape(-1)
+        if self.preconditioner is None:
+            return z.reshape(-1)
+        with torch.no_grad():
+            z = torch.from_numpy(z.reshape(self.B, self.N, -1, 2)).to(self.preconditioner.weight.device)
+            return self.preconditioner.synthesis(z).cpu().numpy().reshape(-1)
+
+    def format_flat(self, x: np.ndarray) -> torch.tensor:
+        """ Transforms x into a flat tensor on the device of the solver. """
+        x = torch.from_numpy(x.reshape(-1))
+        if self.is_cuda:
+            x = x.cuda()
+        return x
 
-        # format x and set gradient to 0
-        x_torch = self.format(x)
+    def clock(self) -> float:
+        """ Current time, after the pending device work is done. """
+        if self.is_cuda:
+            torch.cuda.synchronize()
+        return time()
+
+    def lookup(self, x: torch.tensor, bs: Optional[np.ndarray] = None) -> Optional[int]:
+        """ Position in the cache of an evaluation at x, compared on its device, None if not cached. """
+        for i, (x_c, bs_c, _, _, _) in enumerate(self.cache):
+            if (bs is None) != (bs_c is None) or (bs is not None and not np.array_equal(bs, bs_c)):
+                continue
+            if x_c.shape == x.shape and x_c.dtype == x.dtype and torch.equal(x_c, x.detach()):
+                return i
+        return None
+
+    def synthesis(self, x_leaf: torch.tensor) -> torch.tensor:
+        """ The signal given to the model from the leaf variable of an evaluation. It is rebuilt for each chunk, as
+        the backward pass of a chunk frees its graph. """
+        if self.support is not None:
+            return self.x_fixed.index_copy(-1, self.support, x_leaf).unsqueeze(-2).unsqueeze(-2)
+        if self.preconditioner is None:
+            return x_leaf
+        return self.preconditioner.synthesis(x_leaf).unsqueeze(-2).unsqueeze(-2)
+
+    def joint_torch(self, x: torch.tensor, bs: Optional[np.ndarray] = None) -> Tuple[torch.tensor, torch.tensor]:
+        """ Computes the loss and its gradient on a flat tensor, without leaving the device.
+
+        :param x: flat tensor
+        :param bs: for deglitching, evaluates the loss on this subset of the noise realizations only
+        """
+
+        i = self.lookup(x, bs) if self.cache_size > 0 else None
+        if i is not None:
+            self.nhits += 1
+            self.cache.append(self.cache.pop(i))
+            _, _, loss, grad_x, self.tracked = self.cache[-1]
+            self.res = loss, grad_x
+            return loss, grad_x
+
+        self.nfev += 1
+        if self.profile:
+            tic = self.clock()
+            timing = {'type': 'eval', 'nfev': self.nfev, 'it': self.counter,
+                      'outside': 0.0 if self.toc_eval is None else tic - self.toc_eval,
+                      'forward': 0.0, 'loss': 0.0, 'backward': 0.0, 'copy': 0.0}
+
+        # format x and set gradient to 0, the signal is rebuilt from x_leaf for each chunk, see synthesis
+        if self.support is not None:
+            x_leaf = Variable(x.detach().reshape(self.B, self.N, -1), requires_grad=True)
+        elif self.preconditioner is None:
+            x_leaf = Variable(x.detach().reshape(self.B, self.N, -1).unsqueeze(-2).unsqueeze(-2), requires_grad=True)
+        else:
+            x_leaf = Variable(x.detach().reshape(self.B, self.N, -1, 2), requires_grad=True)
 
-        res_max = {c_type: 0.0 for c_type in self.model.module.c_types}
-        res_max_pct = {c_type: 0.0 for c_type in self.model.module.c_types}
+        # the gaps tracked by the loss, gap statistics are only computed on demand
+        self.tracked = []
 
         # chunk gradient computation if necessary
         # for deglitching it is not equivalent to computing the gradient once
-        if self.model.nchunks > 1:
+        # gradients of the chunks are accumulated into x_leaf.grad, each chunk's graph is freed by backward
+        if bs is not None:
+            chunks = [{'bs': bs}]
+        elif self.model.nchunks > 1:
+            chunks = [{'i_chunk': i_chunk} for i_chunk in range(self.model.nchunks)]
+        else:
+            chunks = [{}]
 
-            total_loss = 0.0
-            total_grad = np.zeros(x_torch.shape, dtype=np.float64)
+        total_loss = 0.0
+        for chunk in chunks:
+            # compute moments
+            Rxt = self.model(self.synthesis(x_leaf), **chunk)
+            if self.profile:
+                timing['forward'] += self.clock() - tic
+                tic = self.clock()
 
-            for i_chunk in range(self.model.nchunks):
-                # clear gradient
-                if x_torch.grad is not None:
-                    x_torch.grad.x.zero_()
+            loss = self.loss(Rxt, self.Rxf, None, None)
+            self.tracked.append(self.loss.tracked)
+            if self.profile:
+                timing['loss'] += self.clock() - tic
+                tic = self.clock()
 
-                Rxt = self.model(x_torch, i_chunk)
+            # compute gradient
+            loss.backward()
+            if self.profile:
+                timing['backward'] += self.clock() - tic
+                tic = self.clock()
 
-                loss = self.loss(Rxt, self.Rxf, None, None)
-                res_max = {c_type: max(res_max[c_type], self.loss.max_gap[c_type] if c_type in self.loss.max_gap else 0.0)
-                           for c_type in self.model.module.c_types}
-                res_mean_pct = {c_type: max(res_max_pct[c_type],
-                                            self.loss.mean_gap_pct[c_type] if c_type in self.loss.mean_gap_pct else 0.0)
-                                for c_type in self.model.module.c_types}
-                res_max_pct = {c_type: max(res_max_pct[c_type],
-                                           self.loss.max_gap_pct[c_type] if c_type in self.loss.max_gap_pct else 0.0)
-                               for c_type in self.model.module.c_types}
+            total_loss += loss.detach() / len(chunks)
 
-                # compute gradient
-                grad_x, = grad([loss], [x_torch], retain_graph=True)
+        loss = total_loss
+        grad_x = x_leaf.grad
 
-                # move to numpy
-                loss = loss.detach().cpu().numpy()
-                grad_x = grad_x.contiguous().detach().cpu().numpy()
+        if self.fixed_ts is not None:
+            grad_x[..., self.fixed_ts] = 0.0
 
-                total_loss += loss / self.model.nchunks
-                total_grad += grad_x
+        grad_x = grad_x.reshape(-1)
+        self.res = loss, grad_x
 
-            if self.fixed_ts is not None:
-                total_grad[..., self.fixed_ts] = 0.0
+        if self.cache_size > 0:
+            # x is copied as optimizers may update it in place
+            self.cache.append((x.detach().clone(), None if bs is None else np.copy(bs), loss, grad_x, self.tracked))
+            if len(self.cache) > self.cache_size:
+                self.cache.pop(0)
 
-            self.res = total_loss, total_grad.ravel(), res_max, res_mean_pct, res_max_pct
+        if self.profile:
+            self.timings.append(timing)
+            self.toc_eval = self.clock()
 
-            return total_loss, total_grad.ravel()
+        return loss, grad_x
 
-        else:
-            # clear gradient
-            if x_torch.grad is not None:
-                x_torch.grad.x.zero_()
+    def gap_statistics(self) -> Tuple[Dict, Dict, Dict]:
+        """ Max gap, mean relative gap and max relative gap per coefficient type at the last evaluation, maximum
+        over chunks. """
+        res_max = {c_type: 0.0 for c_type in self.model.module.c_types}
+        res_mean_pct = {c_type: 0.0 for c_type in self.model.module.c_types}
+        res_max_pct = {c_type: 0.0 for c_type in self.model.module.c_types}
+        for tracked in self.tracked:
+            max_gap, mean_gap_pct, max_gap_pct = self.loss.compute_gap_statistics(*tracked)
+            for c_type in self.model.module.c_types:
+                res_max[c_type] = max(res_max[c_type], max_gap.get(c_type, 0.0))
+                res_mean_pct[c_type] = max(res_mean_pct[c_type], mean_gap_pct.get(c_type, 0.0))
+                res_max_pct[c_type] = max(res_max_pct[c_type], max_gap_pct.get(c_type, 0.0))
+        return res_max, res_mean_pct, res_max_pct
+
+    def joint(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Computes the loss on current vector. """
+        tic = time()
+        x = self.format_flat(x)
+        copy_in = time() - tic
 
-            # compute moments
-            Rxt = self.model(x_torch)
+        nhits = self.nhits
+        loss, grad_x = self.joint_torch(x)
 
-            loss = self.loss(Rxt, self.Rxf, None, None)
-            res_max = {c_type: max(res_max[c_type], self.loss.max_gap[c_type] if c_type in self.loss.max_gap else 0.0)
-                       for c_type in self.model.module.c_types}
-            res_mean_pct = {c_type: max(res_max_pct[c_type], self.loss.mean_gap_pct[c_type] if c_type in self.loss.mean_gap_pct else 0.0)
-                            for c_type in self.model.module.c_types}
-            res_max_pct = {c_type: max(res_max_pct[c_type], self.loss.max_gap_pct[c_type] if c_type in self.loss.max_gap_pct else 0.0)
-                           for c_type in self.model.module.c_types}
+        # move to numpy
+        tic = time()
+        loss = loss.cpu().numpy()
+        grad_x = grad_x.cpu().numpy().astype(np.float64)
 
-            # compute gradient
-            grad_x, = grad([loss], [x_torch], retain_graph=True)
+        self.res = loss, grad_x
 
-            # move to numpy
-            grad_x = grad_x.contiguous().detach().cpu().numpy()
-            loss = loss.detach().cpu().numpy()
+        if self.profile and self.nhits == nhits:
+            self.timings[-1]['copy'] = copy_in + time() - tic
+            self.timings[-1]['outside'] -= copy_in
+            self.toc_eval = time()
 
-            if self.fixed_ts is not None:
-                grad_x[..., self.fixed_ts] = 0.0
+        return loss, grad_x
 
-            self.res = loss, grad_x.ravel(), res_max, res_mean_pct, res_max_pct
 
-            return loss, grad_x.ravel()
+class EarlyStoppingException(Exception):
+    """ Raised by the callback to stop the optimization, the message is the stopping reason. """
+    pass
 
 
-class SmallEnoughException(Exception):
+class SmallEnoughException(EarlyStoppingException):
     pass
 
 
@@ -149,7 +285,29 @@ class CheckConvCriterion:
                  solver: Solver,
                  tol: float,
                  max_wait: Optional[int] = 100,
-                 save_data_evolution_p: Optional[bool] = False):
+                 save_data_evolution_p: Optional[bool] = False,
+                 diagnostics: Optional[Union[str, int]] = 'milestone',
+                 checkpoint_path: Optional[Path] = None,
+                 checkpoint_every: Optional[int] = None,
+                 checkpoint_key: Optional[str] = None,
+                 early_stopping: Optional[Dict] = None):
+        """
+        :param diagnostics: when to compute the gap statistics of the loss, which requires device syncs:
+            'always': at every iteration, 'milestone': only when an info line is printed,
+            k: every k iterations and when an info line is printed
+        :param checkpoint_path: file in which x_k, the iteration counter, the loss history and the optimizer state
+            are saved
+        :param checkpoint_every: save a checkpoint every k iterations, None disables checkpointing
+        :param checkpoint_key: key of the optimization problem saved in the checkpoint, a checkpoint with another key
+            is not resumed
+        :param early_stopping: dict of stopping policies in addition to the tolerance, each one optional:
+            'window' and 'rtol': stop when the relative loss improvement over the last window iterations is below rtol,
+            'gtol': stop when the max absolute gradient is below gtol,
+            'max_time': wall-clock budget in seconds, 'max_fev': budget of loss and gradient evaluations
+        """
+        if diagnostics not in ['always', 'milestone'] and not (
+                isinstance(diagnostics, int) and not isinstance(diagnostics, bool) and diagnostics >= 1):
+            raise ValueError("Unrecognized diagnostics policy, should be 'always', 'milestone' or a positive integer.")
         self.solver = solver
         self.tol = tol
         self.result = None
@@ -157,25 +315,91 @@ class CheckConvCriterion:
         self.counter = 0
         self.err = None
         self.max_gap = None
+        self.mean_gap_pct = None
+        self.max_gap_pct = None
         self.gerr = None
         self.tic = time()
 
         self.max_wait, self.wait = max_wait, 0
         self.save_data_evolution_p = save_data_evolution_p
+        self.diagnostics = diagnostics
+        self.checkpoint_path, self.checkpoint_every = checkpoint_path, checkpoint_every
+        self.checkpoint_key = checkpoint_key
+        self.optimizer = None  # optimizer whose state is checkpointed, if it exposes one
+        self.early_stopping = early_stopping or {}
+        self.timing = None  # timing record of the current iteration
+        self.stop_reason = None
 
         self.logs_loss = []
         self.logs_grad = []
         self.logs_x = []
+        self.logs_gap = []  # (iteration, max_gap, mean_gap_pct, max_gap_pct)
+
+    def update_gap_statistics(self) -> None:
+        """ Compute the gap statistics at the last evaluation of the solver. """
+        tic = time()
+        self.max_gap, self.mean_gap_pct, self.max_gap_pct = self.solver.gap_statistics()
+        if self.timing is not None:
+            self.timing['diagnostics'] += time() - tic
+        self.logs_gap.append((self.counter, self.max_gap, self.mean_gap_pct, self.max_gap_pct))
+
+    def save_checkpoint(self, xk: Union[np.ndarray, torch.tensor]) -> None:
+        """ Save x_k, the iteration counter, the loss history and the optimizer state. """
+        state = {
+            'x': xk.detach().cpu().clone() if torch.is_tensor(xk) else torch.from_numpy(np.copy(xk)),
+            'counter': self.counter,
+            'logs_loss': self.logs_loss,
+            'logs_grad': self.logs_grad,
+            'optimizer': None if self.optimizer is None else self.optimizer.state_dict(),
+            'key': self.checkpoint_key
+        }
+        # write then rename so that an interrupted save does not corrupt the previous checkpoint
+        path_tmp = self.checkpoint_path.with_suffix('.tmp')
+        torch.save(state, str(path_tmp))
+        os.replace(str(path_tmp), str(self.checkpoint_path))
 
-    def __call__(self, xk: np.ndarray) -> None:
-        err, grad_xk, max_gap, mean_gap_pct, max_gap_pct = self.solver.res
-
-        gerr = np.max(np.abs(grad_xk))
+    @staticmethod
+    def read_checkpoint(checkpoint_path: Optional[Path], checkpoint_key: Optional[str] = None) -> Optional[Dict]:
+        """ The checkpoint saved at checkpoint_path, None if there is none or if it was saved for another key. """
+        if checkpoint_path is None or not checkpoint_path.is_file():
+            return None
+        state = torch.load(str(checkpoint_path), map_location='cpu')
+        if state.get('key') != checkpoint_key:
+            print("Ignoring a checkpoint saved for other parameters.")
+            return None
+        return state
+
+    def load_checkpoint(self, state: Optional[Dict] = None) -> Optional[Dict]:
+        """ Restore the iteration counter and the loss history from the checkpoint, if any, and return it.
+
+        :param state: the checkpoint if already read, see read_checkpoint
+        """
+        if state is None:
+            state = self.read_checkpoint(self.checkpoint_path, self.checkpoint_key)
+        if state is None:
+            return None
+        self.counter = self.solver.counter = state['counter']
+        self.logs_loss, self.logs_grad = state['logs_loss'], state['logs_grad']
+        return state
+
+    def __call__(self, xk: Union[np.ndarray, torch.tensor]) -> None:
+        tic = time()
+        self.timing = {'type': 'iter', 'it': self.counter + 1, 'nfev': self.solver.nfev, 'diagnostics': 0.0,
+                       'checkpoint': 0.0, 'callback': 0.0}
+        try:
+            self.check(xk)
+        finally:
+            if self.solver.profile:
+                self.timing['callback'] = time() - tic
+                self.solver.timings.append(self.timing)
+
+    def check(self, xk: Union[np.ndarray, torch.tensor]) -> None:
+        """ Log the current iterate and stop the optimization if a stopping criterion is met. """
+        err, grad_xk = self.solver.res
+
+        gerr = torch.abs(grad_xk).max() if torch.is_tensor(grad_xk) else np.max(np.abs(grad_xk))
         err, gerr = float(err), float(gerr)
         self.err = err
-        self.max_gap = max_gap
-        self.mean_gap_pct = mean_gap_pct
-        self.max_gap_pct = max_gap_pct
         self.gerr = gerr
         self.counter += 1
         self.solver.counter += 1
@@ -183,6 +407,14 @@ class CheckConvCriterion:
         self.logs_loss.append(err)
         self.logs_grad.append(gerr)
 
+        if self.diagnostics == 'always' or (isinstance(self.diagnostics, int) and self.counter % self.diagnostics == 0):
+            self.update_gap_statistics()
+
+        if self.checkpoint_every is not None and self.counter % self.checkpoint_every == 0:
+            tic = time()
+            self.save_checkpoint(xk)
+            self.timing['checkpoint'] += time() - tic
+
         if self.next_milestone is None:
             self.next_milestone = 10 ** (np.floor(np.log10(gerr)))
 
@@ -194,8 +426,16 @@ class CheckConvCriterion:
 
         if np.sqrt(err) <= self.tol:
             self.result = xk
-            raise SmallEnoughException()
-        elif gerr <= self.next_milestone or self.wait >= self.max_wait:
+            self.stop_reason = "SmallEnoughException"
+            raise SmallEnoughException(self.stop_reason)
+
+        self.stop_reason = self.check_early_stopping()
+        if self.stop_reason is not None:
+            self.result = xk
+            self.print_info_line()
+            raise EarlyStoppingException(self.stop_reason)
+
+        if gerr <= self.next_milestone or self.wait >= self.max_wait:
             if not info_already_printed_p:
                 self.print_info_line()
             if gerr <= self.next_milestone:
@@ -204,8 +444,28 @@ class CheckConvCriterion:
         else:
             self.wait += 1
 
+    def check_early_stopping(self) -> Optional[str]:
+        """ The reason for stopping at this iteration according to the early stopping policies, if any. """
+        window, rtol = self.early_stopping.get('window'), self.early_stopping.get('rtol', 1e-3)
+        if window is not None and len(self.logs_loss) > window:
+            loss_old, loss_new = self.logs_loss[-window - 1], self.logs_loss[-1]
+            if loss_old - loss_new <= rtol * abs(loss_old):
+                return f"STOP: REL_REDUCTION_OF_F_OVER_{window}_ITERATIONS_<=_{rtol:.1e}"
+        gtol = self.early_stopping.get('gtol')
+        if gtol is not None and self.gerr <= gtol:
+            return f"CONVERGENCE: NORM_OF_GRADIENT_<=_{gtol:.1e}"
+        max_time = self.early_stopping.get('max_time')
+        if max_time is not None and time() - self.tic >= max_time:
+            return f"STOP: WALL-CLOCK TIME EXCEEDS BUDGET OF {max_time:g}s"
+        max_fev = self.early_stopping.get('max_fev')
+        if max_fev is not None and self.solver.nfev >= max_fev:
+            return f"STOP: TOTAL NO. OF F,G EVALUATIONS EXCEEDS BUDGET OF {max_fev}"
+        return None
+
     def print_info_line(self, msg: Optional[str] = '') -> None:
         delta_t = time() - self.tic
+        if not self.logs_gap or self.logs_gap[-1][0] != self.counter:
+            self.update_gap_statistics()
 
         def cap(pct):
             return pct if pct < 1e3 else np.inf
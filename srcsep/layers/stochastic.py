@@ -0,0 +1,88 @@
+""" A stochastic optimizer sampling the noise realizations of the deglitching loss. """
+from typing import *
+import numpy as np
+import torch
+
+
+class StochasticAdam:
+    """ Adam on mini-batches of noise realizations, with a step decay of the learning rate.
+
+    Each step evaluates the loss on a random subset of the realizations only. The full objective is evaluated every
+    eval_every steps, this is the one the callback sees through the solver, so that convergence is monitored and
+    reported on the full objective.
+    """
+    def __init__(self,
+                 fun_batch: Callable[[torch.Tensor, np.ndarray], Tuple[torch.Tensor, torch.Tensor]],
+                 fun_full: Callable[[torch.Tensor], Tuple[torch.Tensor, torch.Tensor]],
+                 n_realizations: int,
+                 batch_size: int,
+                 lr: float,
+                 lr_decay: float = 0.5,
+                 decay_every: int = 500,
+                 eval_every: int = 50,
+                 seed: Optional[int] = None) -> None:
+        if not 0 < batch_size <= n_realizations:
+            raise ValueError(f"Batch size should be in [1, {n_realizations}], got {batch_size}.")
+        self.fun_batch = fun_batch  # (x, realization indices) -> (loss, gradient), x being a flat tensor
+        self.fun_full = fun_full  # x -> (loss, gradient) on all realizations
+        self.n_realizations, self.batch_size = n_realizations, batch_size
+        self.lr, self.lr_decay, self.decay_every = lr, lr_decay, decay_every
+        self.eval_every = eval_every
+        self.rng = np.random.default_rng(seed)
+
+        self.nit, self.nfev = 0, 0
+        self.optimizer, self.scheduler = None, None
+        self.resumed = None  # state loaded before minimize, see load_state_dict
+
+    def state_dict(self) -> Dict:
+        """ The optimizer state: step counters, sampler state, Adam moments and learning rate schedule. """
+        return {'nit': self.nit, 'nfev': self.nfev, 'rng': self.rng.bit_generator.state,
+                'adam': None if self.optimizer is None else self.optimizer.state_dict(),
+                'scheduler': None if self.scheduler is None else self.scheduler.state_dict()}
+
+    def load_state_dict(self, state: Dict, device: Optional[torch.device] = None) -> None:
+        """ Resume from state, the Adam moments being restored on the device of x0 by minimize. """
+        self.nit, self.nfev = state['nit'], state['nfev']
+        self.rng.bit_generator.state = state['rng']
+        self.resumed = state
+
+    def sample(self) -> np.ndarray:
+        return np.sort(self.rng.choice(self.n_realizations, self.batch_size, replace=False))
+
+    def minimize(self,
+                 x0: torch.Tensor,
+                 maxiter: int,
+                 callback: Optional[Callable[[torch.Tensor], None]] = None) -> Dict:
+        """ Minimize the full objective starting from x0.
+
+        :param x0: a flat tensor
+        :param maxiter: maximum number of stochastic steps, including the steps of a resumed state
+        :param callback: called on the iterate after each evaluation of the full objective
+        :return: a dict with keys fun, x, nit, nfev, message as scipy.optimize.minimize, fun being the full objective
+        """
+        x = x0.detach().clone()
+        optimizer = self.optimizer = torch.optim.Adam([x], lr=self.lr)
+        scheduler = self.scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=self.decay_every,
+                                                                     gamma=self.lr_decay)
+        if self.resumed is not None and self.resumed['adam'] is not None:
+            optimizer.load_state_dict(self.resumed['adam'])
+            scheduler.load_state_dict(self.resumed['scheduler'])
+
+        while self.nit < maxiter:
+            _, grad = self.fun_batch(x, self.sample())
+            x.grad = grad.detach()
+            optimizer.step()
+            scheduler.step()
+            self.nit += 1
+
+            if self.nit % self.eval_every == 0:
+                self.nfev += 1
+                self.fun_full(x)
+                if callback is not None:
+                    callback(x.detach().clone())  # x is updated in place by the next steps
+
+        f, _ = self.fun_full(x)
+        self.nfev += 1
+
+        return {'fun': float(f), 'x': x.detach().clone(), 'nit': self.nit, 'nfev': self.nfev,
+                'message': "STOP: TOTAL NO. OF ITERATIONS REACHED LIMIT"}
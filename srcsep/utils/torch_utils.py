@@ -1,5 +1,6 @@
 """ Utils function for manipulating tensors. """
 from typing import *
+import hashlib
 import numpy as np
 import torch
 
@@ -20,6 +21,35 @@ def to_numpy(tensor):
     return tensor.detach().numpy()
 
 
+def hash_data(*objs) -> str:
+    """ Hex digest of nested dicts, lists and tuples of arrays, tensors and other values, arrays being hashed on their
+    dtype, shape and bytes and other values on their repr. """
+    key = hashlib.sha1()
+
+    def update(obj):
+        if torch.is_tensor(obj):
+            obj = obj.detach().cpu().numpy()
+        if isinstance(obj, np.ndarray):
+            key.update(repr((obj.dtype.str, obj.shape)).encode())
+            key.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj, dict):
+            key.update(f"dict{len(obj)}".encode())
+            for name in sorted(obj, key=str):
+                key.update(repr(name).encode())
+                update(obj[name])
+        elif isinstance(obj, (list, tuple)):
+            key.update(f"{type(obj).__name__}{len(obj)}".encode())
+            for item in obj:
+                update(item)
+        else:
+            key.update(repr(obj).encode())
+
+    for obj in objs:
+        update(obj)
+
+    return key.hexdigest()
+
+
 def multid_where(a: Iterable, b: Iterable) -> List:
     """ Find the position in b of each element of a.
 
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.signal.windows import tukey
 
 def windows(x, window_size, stride, offset):
     """ Separate x into windows on last axis, discard any residual.
@@ -9,4 +10,27 @@ def windows(x, window_size, stride, offset):
         for i in range(num_window)
     ], -2)  # (C) x nb_w x w
 
-    return windowed_x
\ No newline at end of file
+    return windowed_x
+
+
+def window_starts(T, window_size, stride, offset):
+    """ Start index of each window of windows on a signal of size T.
+    """
+    num_window = int((T - window_size - offset) // stride + 1)
+    return offset + stride * np.arange(num_window)
+
+
+def window_tapers(T, window_size, stride, offset, alpha):
+    """ Tukey taper of each window of windows, normalized so that the tapers of the windows covering a sample add up
+    to one. The first and last windows are not tapered on the edges of the signal.
+    """
+    starts = window_starts(T, window_size, stride, offset)
+    tapers = np.tile(tukey(window_size + 2, alpha)[1:-1], (starts.size, 1))  # positive everywhere
+    tapers[0, :window_size // 2] = 1.0
+    tapers[-1, window_size // 2:] = 1.0
+
+    total = np.zeros(T)
+    for start, taper in zip(starts, tapers):
+        total[start:start + window_size] += taper
+
+    return tapers / total[starts[:, None] + np.arange(window_size)]